@@ -8,8 +8,24 @@ reset()
 close()
 These functions are mandatory. This file contains minimum working versions 
 of these functions, adapt as required for individual research goals.
+
+With trialsPerProcess and batchSteps set, the trials of a host that are due
+at the same time are rendered and stepped together (see multitrial.py). The
+Agent class can then optionally provide:
+render_batch(agents)
+step_batch(agents, actions)
+as static methods taking the Agent instances of the batch (and the action of
+each) and returning a list with the render() or step() return of each, for
+example from a vectorised environment that steps every agent's environment
+in one operation. Without them render() and step() are called for each Agent.
+
+Resets go through a SnapshotCache (see snapshot.py), which restores Atari
+games to a cached initial state rather than resetting the emulator, and lets
+rewind() return the environment to an earlier step of the episode, for
+example to replay a segment to the participant.
 '''
 import gym
+from snapshot import SnapshotCache
 
 class Agent():
     '''
@@ -28,6 +44,7 @@ class Agent():
             Mandatory
         '''
         self.env = gym.make(game)
+        self.snapshots = SnapshotCache(self.env, game)
         return
     
     def step(self, action:int):
@@ -43,6 +60,7 @@ class Agent():
               change contents of dict as desired, but return must be type dict.
         '''
         observation, reward, done, info = self.env.step(action)
+        self.snapshots.record(action, observation)
         envState = {'observation': observation, 'reward': reward, 'done': done, 'info': info}
         return envState
     
@@ -57,6 +75,9 @@ class Agent():
             - return from env.render('rgb_array') (Type: npArray)
               must return the unchanged rgb_array
         '''
+        frame = self.snapshots.frame()
+        if frame is not None:
+            return frame
         return self.env.render('rgb_array')
     
     def reset(self):
@@ -69,7 +90,18 @@ class Agent():
         Returns: 
             No Return
         '''
-        self.env.reset()
+        self.snapshots.reset()
+
+    def rewind(self, step:int):
+        '''
+        Returns the environment to an earlier step of the current episode.
+        Optional, not called by trial.py.
+        Inputs:
+            - step (Type: int, steps since the last reset)
+        Returns:
+            - observation (Type: the observation after that step)
+        '''
+        return self.snapshots.rewind(step)
     
     def close(self):
         '''
@@ -0,0 +1,230 @@
+'''
+Per-trial archives of episode log files, used when archiveEpisodes is set so
+that a trial is stored in s3 as one object rather than one per episode.
+
+Archive layout:
+    episode file, episode file, ...
+    index: json list of {'name', 'offset', 'length'} for each episode file
+    FOOTER: ARCHIVE_MAGIC, offset of the index (uint64), length of the index
+            (uint64)
+
+The UploadService appends each episode file to a local copy of the archive
+as the episode finishes and uploads the archive as a multipart upload, one
+part whenever partSize bytes have accumulated, so most of a trial is in s3
+before it ends. Progress is saved next to the local archive, so a restarted
+container carries on with the same multipart upload.
+
+An analyst can fetch a single episode with two small range requests for the
+footer and index and one for the episode:
+    client = boto3.client('s3')
+    episodes = list_episodes(client, bucket, key)
+    data = fetch_episode(client, bucket, key, 'episode_3_user_x')
+'''
+import json, logging, os, struct
+from botocore.exceptions import ClientError
+
+ARCHIVE_MAGIC = b'HGARCH1\n'
+FOOTER = struct.Struct('<8sQQ')
+MIN_PART_SIZE = 5 * 1024 * 1024 # s3 limit for every part but the last
+
+class TrialArchive():
+    '''
+    An archive being built at localPath and uploaded to s3 at bucket/key.
+    '''
+
+    def __init__(self, client, bucket:str, key:str, localPath:str, partSize:int=8388608):
+        self.client = client
+        self.localPath = localPath
+        self.statePath = localPath + '.state'
+        self.partSize = max(partSize, MIN_PART_SIZE)
+        if os.path.exists(self.statePath):
+            with open(self.statePath) as infile:
+                self.state = json.load(infile)
+        else:
+            upload = client.create_multipart_upload(Bucket=bucket, Key=key)
+            self.state = {'bucket': bucket, 'key': key, 'uploadId': upload['UploadId'],
+                          'parts': [], 'uploaded': 0, 'size': 0, 'index': [], 'jobs': []}
+            self.include_existing()
+            self.save_state()
+        if not self.state.get('completed'):
+            with open(self.localPath, 'ab') as outfile:
+                outfile.truncate(self.state['size']) # drop an append interrupted by a crash
+
+    def include_existing(self):
+        '''
+        Starts the archive with the episodes of an archive already completed
+        at its key, so that completing this one does not replace them. The
+        episodes are copied within s3 as the first part if they are large
+        enough to be one, and downloaded otherwise. If the key holds an
+        object that is not an archive, the upload is aborted and ValueError
+        raised rather than replace it.
+        '''
+        bucket, key = self.state['bucket'], self.state['key']
+        try:
+            index = list_episodes(self.client, bucket, key)
+        except ClientError:
+            index = [] # nothing there yet
+        except ValueError:
+            logging.error(f's3://{bucket}/{key} is not a trial archive, not replacing it')
+            self.client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=self.state['uploadId'])
+            raise
+        size = max((entry['offset'] + entry['length'] for entry in index), default=0)
+        with open(self.localPath, 'wb') as outfile:
+            if size >= MIN_PART_SIZE:
+                part = self.client.upload_part_copy(Bucket=bucket, Key=key, UploadId=self.state['uploadId'], PartNumber=1,
+                    CopySource={'Bucket': bucket, 'Key': key}, CopySourceRange=f'bytes=0-{size - 1}')
+                self.state['parts'].append({'PartNumber': 1, 'ETag': part['CopyPartResult']['ETag']})
+                self.state['uploaded'] = size
+                outfile.truncate(size) # never read, upload_parts starts from 'uploaded'
+            elif size:
+                outfile.write(fetch_range(self.client, bucket, key, 0, size))
+        self.state['index'] = index
+        self.state['size'] = size
+
+    def save_state(self):
+        tempPath = self.statePath + '.tmp'
+        with open(tempPath, 'w') as outfile:
+            json.dump(self.state, outfile)
+        os.replace(tempPath, self.statePath)
+
+    def append(self, name:str, path:str, jobId:str=None):
+        '''
+        Appends a file to the archive and uploads any full parts. Returns the
+        name the file is stored under. jobId identifies the upload job, so
+        that a job run again after a retry or restart is appended once.
+        '''
+        jobs = self.state.setdefault('jobs', [])
+        if jobId is None or jobId not in jobs:
+            name = self.unique_name(name)
+            with open(path, 'rb') as infile, open(self.localPath, 'ab') as outfile:
+                length = copy_file(infile, outfile)
+            self.state['index'].append({'name': name, 'offset': self.state['size'], 'length': length})
+            self.state['size'] += length
+            if jobId is not None:
+                jobs.append(jobId)
+            self.save_state()
+        self.upload_parts()
+        return name
+
+    def unique_name(self, name:str):
+        names = {entry['name'] for entry in self.state['index']}
+        unique = name
+        count = 1
+        while unique in names:
+            count += 1
+            unique = f'{name}_{count}'
+        if unique != name:
+            logging.warning(f'{self.state["key"]} already has {name}, storing it as {unique}')
+        return unique
+
+    def finish(self):
+        '''
+        Writes the index and footer, uploads the rest of the archive and
+        completes the multipart upload. Removes the local archive, but keeps
+        the state, marked completed, until remove_state() is called once the
+        finish job is removed, so that finishing again does nothing.
+        '''
+        if not self.state.get('completed'):
+            if not self.state.get('finished'):
+                index = json.dumps(self.state['index']).encode('utf-8')
+                with open(self.localPath, 'ab') as outfile:
+                    outfile.write(index)
+                    outfile.write(FOOTER.pack(ARCHIVE_MAGIC, self.state['size'], len(index)))
+                self.state['size'] += len(index) + FOOTER.size
+                self.state['finished'] = True
+                self.save_state()
+            self.upload_parts(final=True)
+            try:
+                self.client.complete_multipart_upload(Bucket=self.state['bucket'], Key=self.state['key'],
+                    UploadId=self.state['uploadId'], MultipartUpload={'Parts': self.state['parts']})
+            except ClientError as error:
+                if error.response['Error']['Code'] != 'NoSuchUpload' or not self.completed():
+                    raise
+            self.state['completed'] = True
+            self.save_state()
+        if os.path.exists(self.localPath):
+            os.remove(self.localPath)
+
+    def completed(self):
+        '''
+        Returns True if the archive in s3 is this one, completed before a
+        crash that kept it from being recorded.
+        '''
+        try:
+            head = self.client.head_object(Bucket=self.state['bucket'], Key=self.state['key'])
+        except ClientError:
+            return False
+        return head['ContentLength'] == self.state['size']
+
+    def remove_state(self):
+        if os.path.exists(self.statePath):
+            os.remove(self.statePath)
+
+    def upload_parts(self, final:bool=False):
+        '''
+        Uploads the archive in parts of partSize bytes, and with final set,
+        whatever remains as the last part.
+        '''
+        with open(self.localPath, 'rb') as infile:
+            while True:
+                remaining = self.state['size'] - self.state['uploaded']
+                if remaining <= 0 or (remaining < self.partSize and not final):
+                    return
+                infile.seek(self.state['uploaded'])
+                body = infile.read(min(remaining, self.partSize))
+                partNumber = len(self.state['parts']) + 1
+                part = self.client.upload_part(Bucket=self.state['bucket'], Key=self.state['key'],
+                    UploadId=self.state['uploadId'], PartNumber=partNumber, Body=body)
+                self.state['parts'].append({'PartNumber': partNumber, 'ETag': part['ETag']})
+                self.state['uploaded'] += len(body)
+                self.save_state()
+
+def copy_file(infile, outfile, blockSize:int=1048576):
+    length = 0
+    while True:
+        block = infile.read(blockSize)
+        if not block:
+            return length
+        outfile.write(block)
+        length += len(block)
+
+def fetch_range(client, bucket:str, key:str, start:int, length:int):
+    response = client.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{start + length - 1}')
+    return response['Body'].read()
+
+def list_episodes(client, bucket:str, key:str):
+    '''
+    Returns the index of an archive in s3: a list of {'name', 'offset',
+    'length'} for each episode file.
+    '''
+    size = client.head_object(Bucket=bucket, Key=key)['ContentLength']
+    if size < FOOTER.size:
+        raise ValueError(f's3://{bucket}/{key} is not a trial archive')
+    magic, offset, length = FOOTER.unpack(fetch_range(client, bucket, key, size - FOOTER.size, FOOTER.size))
+    if magic != ARCHIVE_MAGIC:
+        raise ValueError(f's3://{bucket}/{key} is not a trial archive')
+    return json.loads(fetch_range(client, bucket, key, offset, length))
+
+def fetch_episode(client, bucket:str, key:str, name:str, index:list=None):
+    '''
+    Returns the bytes of one episode file from an archive in s3. Pass the
+    index from list_episodes() to save two requests per episode.
+    '''
+    for entry in index or list_episodes(client, bucket, key):
+        if entry['name'] == name:
+            return fetch_range(client, bucket, key, entry['offset'], entry['length'])
+    raise KeyError(name)
+
+def read_archive(path:str):
+    '''
+    Yields (name, bytes) for each episode file of a downloaded archive.
+    '''
+    with open(path, 'rb') as infile:
+        infile.seek(-FOOTER.size, os.SEEK_END)
+        magic, offset, length = FOOTER.unpack(infile.read(FOOTER.size))
+        if magic != ARCHIVE_MAGIC:
+            raise ValueError(f'{path} is not a trial archive')
+        infile.seek(offset)
+        for entry in json.loads(infile.read(length)):
+            infile.seek(entry['offset'])
+            yield entry['name'], infile.read(entry['length'])
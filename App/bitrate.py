@@ -0,0 +1,120 @@
+import time, logging
+
+# Quality ladder, from best to most degraded. Each level scales the configured
+# frameQuality and frameRate, and multiplies the configured frameScale
+# (a larger scale is a smaller frame).
+LEVELS = [
+    {'quality': 1.0, 'scale': 1.0, 'framerate': 1.0},
+    {'quality': 0.7, 'scale': 1.0, 'framerate': 1.0},
+    {'quality': 0.5, 'scale': 1.5, 'framerate': 1.0},
+    {'quality': 0.4, 'scale': 2.0, 'framerate': 0.75},
+    {'quality': 0.3, 'scale': 2.0, 'framerate': 0.5}
+]
+
+class BitrateController():
+    '''
+    Chooses a level from LEVELS based on feedback about the participant's
+    connection:
+        - round trip times, from the client acknowledging frames with
+          {'ack': frameId}
+        - the number of messages waiting to be sent to the websocket, reported
+          by the communicator as {'sendQueue': {'messages': int, 'bytes': int,
+          'dropped': int}}, with the number of frames it has dropped from the
+          shared memory frame ring for falling behind
+        - frames the Trial dropped because the frame ring was full
+    Any dropped frame counts as congestion.
+    The level drops as soon as the connection is congested (at most once per
+    holdTime seconds) and recovers one level at a time after recoverTime
+    seconds without congestion. Every decision is logged.
+    '''
+
+    def __init__(self, trialId:str, targetLatency:float=0.25, maxSendQueue:int=4, holdTime:float=1.0, recoverTime:float=5.0):
+        self.trialId = trialId
+        self.targetLatency = targetLatency
+        self.maxSendQueue = maxSendQueue
+        self.holdTime = holdTime
+        self.recoverTime = recoverTime
+        self.level = 0
+        self.sentAt = {}
+        self.rtt = None
+        self.sendQueue = 0
+        self.drops = 0 # frames dropped since the last update
+        self.ringDropped = 0 # last count of frames dropped by the communicator
+        now = time.monotonic()
+        self.lastChange = now
+        self.lastCongested = now
+
+    def sent(self, frameId:int):
+        '''
+        Records the time frameId was handed to the communicator. Only called
+        for frames that were, see dropped() for the others.
+        '''
+        self.sentAt[frameId] = time.monotonic()
+        if len(self.sentAt) > 1024:
+            del self.sentAt[next(iter(self.sentAt))]
+
+    def ack(self, frameId:int):
+        '''
+        Updates the smoothed round trip time from a client acknowledgement.
+        Returns True if the level changed.
+        '''
+        sentAt = self.sentAt.pop(frameId, None)
+        while self.sentAt and next(iter(self.sentAt)) < frameId:
+            del self.sentAt[next(iter(self.sentAt))]
+        if sentAt is None:
+            return False
+        sample = time.monotonic() - sentAt
+        self.rtt = sample if self.rtt is None else 0.875 * self.rtt + 0.125 * sample
+        return self.update()
+
+    def queue(self, sendQueue:dict):
+        '''
+        Updates the send queue depth reported by the communicator.
+        Returns True if the level changed.
+        '''
+        self.sendQueue = sendQueue.get('messages', 0)
+        dropped = sendQueue.get('dropped', 0)
+        self.drops += max(0, dropped - self.ringDropped)
+        self.ringDropped = dropped
+        return self.update()
+
+    def dropped(self, count:int=1):
+        '''
+        Records frames that were dropped instead of being handed to the
+        communicator. Returns True if the level changed.
+        '''
+        self.drops += count
+        return self.update()
+
+    def congested(self):
+        return ((self.rtt is not None and self.rtt > self.targetLatency)
+                or self.sendQueue > self.maxSendQueue or self.drops > 0)
+
+    def update(self):
+        '''
+        Moves down a level on congestion, or up a level once the connection
+        has been clear for recoverTime. Returns True if the level changed.
+        '''
+        now = time.monotonic()
+        congested = self.congested()
+        drops, self.drops = self.drops, 0
+        if congested:
+            self.lastCongested = now
+            if self.level < len(LEVELS) - 1 and now - self.lastChange >= self.holdTime:
+                return self.set_level(self.level + 1, now, 'congested', drops)
+        elif self.level > 0 and now - max(self.lastCongested, self.lastChange) >= self.recoverTime:
+            return self.set_level(self.level - 1, now, 'recovered', drops)
+        return False
+
+    def set_level(self, level:int, now:float, reason:str, drops:int=0):
+        logging.info(f'Trial {self.trialId} bitrate level {self.level} -> {level} ({reason}): '
+                     f'rtt={self.rtt} sendQueue={self.sendQueue} drops={drops}')
+        self.level = level
+        self.lastChange = now
+        return True
+
+    def settings(self):
+        '''
+        Returns the multipliers of the current level.
+        '''
+        return LEVELS[self.level]
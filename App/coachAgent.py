@@ -8,6 +8,9 @@ import gym
 import time
 import numpy as np
 import itertools
+from tilecoding import TileCoder
+from traces import EligibilityTrace
+from experience import ExperienceBuffer
 
 
 #This is the code for tile coding features
@@ -97,6 +100,21 @@ class MountainCarTileCoder:
         self.iht = IHT(iht_size)
         self.num_tilings = num_tilings
         self.num_tiles = num_tiles
+        self.minP = -1.2
+        self.maxP = .5
+        self.minV = -.07
+        self.maxV = .07
+        # vectorised tiles(), dense over the whole state space (positions reach 0.6)
+        self.coder = TileCoder(self.iht, num_tilings, [0, 0], self.scale(np.array([0.6, self.maxV])))
+
+    def scale(self, states):
+        """
+            Scales positions and velocities (the last axis of states) to the
+            range [0, num_tiles]
+            """
+        low = np.array([self.minP, self.minV])
+        high = np.array([self.maxP, self.maxV])
+        return (states - low) / (high - low) * self.num_tiles
             
     def get_tiles(self, position, velocity):
         """
@@ -106,25 +124,19 @@ class MountainCarTileCoder:
             returns:
             tiles - np.array, active tiles
             """
-        # Use the ranges above and self.num_tiles to scale position and velocity to the range [0, 1]
-        # then multiply that range with self.num_tiles so it scales from [0, num_tiles]
-        minP=-1.2
-        maxP=.5
-        minV=-.07
-        maxV=.07
-        scaleP= maxP- minP
-        scaleV= maxV-minV
-        
-        position_scaled = ((position-minP)/(scaleP))*self.num_tiles
-        
-        velocity_scaled = ((velocity-minV)/(scaleV))*self.num_tiles
-        
-        
-        # get the tiles using tc.tiles, with self.iht, self.num_tilings and [scaled position, scaled velocity]
-        # nothing to implment here
-        mytiles = tiles(self.iht, self.num_tilings, [position_scaled, velocity_scaled])
-        
-        return np.array(mytiles)
+        # scale position and velocity to the range [0, num_tiles], then get the
+        # tiles of every tiling at once, the same tiles as
+        # tiles(self.iht, self.num_tilings, [scaled position, scaled velocity])
+        return self.coder.get_state_tiles([
+            (position - self.minP) / (self.maxP - self.minP) * self.num_tiles,
+            (velocity - self.minV) / (self.maxV - self.minV) * self.num_tiles])
+
+    def get_tiles_batch(self, states):
+        """
+            Takes an array of (position, velocity) states and returns an array
+            of the active tiles of each state, one row per state.
+            """
+        return self.coder.get_tiles(self.scale(np.asarray(states, dtype=np.float64)))
 
 
 #this is the coach agent class
@@ -153,8 +165,9 @@ class CoachAgent:
         self.num_actions = 3
         self.actions = list(range(self.num_actions))
         self.time_step=0
-        self.experiences= list()
         self.max_n_experiences=1000
+        # ring buffer of (action, tiles, time), oldest first, searchable by time
+        self.experiences= ExperienceBuffer(self.max_n_experiences)
         self.window_size = 2
         self.feedback_delay = 0.6
         self.timestamp = time.time()
@@ -165,8 +178,10 @@ class CoachAgent:
         self.w = np.ones((self.num_actions, self.iht_size))
         
         
-        # intialize trace to be same size as w
-        self.trace = np.zeros(self.w.shape)
+        # intialize trace to be same size as w. The trace only decays at
+        # active tiles (see update_trace), and w += alpha*r*trace is applied
+        # lazily, to a tile's weights when they are read or its trace changes
+        self.trace = EligibilityTrace(self.w)
         
         self.softmax_prob = [0,0,0]
         
@@ -179,19 +194,11 @@ class CoachAgent:
     
 
     def calculate_action_preferences(self, tiles):
-        preferences = []    
-        for a in range(self.num_actions):
-            preferences.append(np.sum(self.w[a][tiles]))
-
-        return preferences
+        return self.trace.sync(tiles).sum(axis=1)
 
     def gradient_logsoftmax(self, chosen_a, softmax_prob):   
-        gradients = np.zeros(self.w.shape[0])
-        for a in self.actions:
-            if a == chosen_a:
-                gradients[a] = (1 - softmax_prob[a])
-            else:
-                gradients[a] = -softmax_prob[a]
+        gradients = -np.asarray(softmax_prob, dtype=np.float64)
+        gradients[chosen_a] += 1
         
         return gradients
 
@@ -236,8 +243,7 @@ class CoachAgent:
         return self.current_action
 
     def update_trace(self, active_tiles, grad):
-        for a in self.actions:
-            self.trace[a,active_tiles] = self.trace[a,active_tiles]*self.trace_decay + grad[a] 
+        self.trace.set(active_tiles, self.trace.get(active_tiles)*self.trace_decay + grad[:, None])
         
 
     
@@ -253,27 +259,17 @@ class CoachAgent:
         elif reward == 'None':
             r = 0
         
-        # First get state-action pair to be assigned credit
+        # First get state-action pair to be assigned credit: the oldest
+        # experience within feedback_delay, or the newest if all are older
         current_time = time.time()
         
-        i = 0                           # index for experience
-        dt = self.feedback_delay + 1      # arbitrary value > self.feedback_delay
-        
-        if len(self.experiences) > 0:
-
-            while dt > self.feedback_delay:
-                expr = self.experiences[i] 
-                dt = current_time - expr[2]  # index 2 of experience holds the timestamp
-                i += 1    
-                if i > len(self.experiences)-1:
-                    break
-            i -= 1 # decrement i so that it corresponds to expr
-        else:
+        if len(self.experiences) == 0:
             return  # the experience buffer is empty; no update is possible
-        
-        # now expr holds the right state-action pair for the update
-        
-        self.experiences = self.experiences[i:]   # remove old experiences from buffer
+
+        # remove old experiences from buffer
+        older = self.experiences.index(current_time - self.feedback_delay)
+        self.experiences.evict(min(older, len(self.experiences) - 1))
+        expr = self.experiences[0]
         
         preferences = self.calculate_action_preferences(expr[1])
         
@@ -287,7 +283,7 @@ class CoachAgent:
         self.update_trace(expr[1],grad) 
         
         # update w
-        self.w += self.alpha*r*self.trace
+        self.trace.update_weights(self.alpha*r)
 
 
    
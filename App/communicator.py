@@ -1,23 +1,40 @@
-import asyncio, websockets, json, sys, pathlib, ssl
-from trial import Trial
-from multiprocessing import Process, Pipe
-from s3upload import Uploader
+import asyncio, websockets, json, sys, pathlib, ssl, struct, time
+from multiprocessing import Pipe, Process
+from trial import load_config
+from s3upload import UploadService
+from pool import TrialPool, TrialWorker
+from multitrial import TrialHosts
 import logging
 
 ADDRESS = None # set desired IP for development 
 PORT = 5000 # if port is changed here it must also be changed in Dockerfile
 devEnv = False
+pool = None
+hosts = None
+uploads = None
+QUEUE_REPORT_INTERVAL = 0.25 # seconds between send queue reports when adaptiveBitrate is set
+MAX_QUEUED_MESSAGES = 16 # messages read from a userTrial's pipe and not yet sent before reading pauses
+END_TRIAL_TIMEOUT = 30 # seconds a disconnected userTrial has to send its last upload requests
 
 logging.basicConfig(filename='server.log', level=logging.INFO)
 
 def main():
     '''
     Check for command line arguement setting development environment.
-    Start Websocket server at appropriate IP ADDRESS and PORT.
+    Start the s3 upload service and Websocket server at appropriate IP 
+    ADDRESS and PORT.
+    Run with 'benchmark' and a number of connections to measure how quickly
+    and at what cpu cost frames get from trials to websockets, polling the
+    trials' pipes as earlier versions did and with the event loop reader:
+        python3 communicator.py benchmark 50
     '''
     global ADDRESS
     global PORT
     global devEnv
+    global pool
+    global hosts
+    global uploads
+    config = load_config()
     if len(sys.argv) > 1 and sys.argv[1] == 'dev':
         start_server = websockets.serve(handler, ADDRESS, PORT)
         devEnv = True
@@ -25,26 +42,48 @@ def main():
         ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
         ssl_context.load_cert_chain('fullchain.pem', keyfile='privkey.pem')
         start_server = websockets.serve(handler, None, PORT, ssl=ssl_context)
+    if not devEnv and config.get('s3upload'):
+        uploads = UploadService(workers=config.get('uploadWorkers', 4), retries=config.get('uploadRetries', 5))
+    if config.get('trialsPerProcess', 1) > 1:
+        hosts = TrialHosts(config, config.get('trialsPerProcess'))
+    elif config.get('trialPoolSize'):
+        pool = TrialPool(config, config.get('trialPoolSize'), config.get('trialPoolWarmup', True))
+        pool.fill()
     asyncio.get_event_loop().run_until_complete(start_server)
     asyncio.get_event_loop().run_forever()
 
 async def handler(websocket, path):
     '''
-    On websocket connection, starts a new userTrial in a new Process.
-    Then starts async listeners for sending and recieving messages.
+    On websocket connection, starts a userTrial on a shared host process if
+    trialsPerProcess is set, takes a pre-started userTrial from the pool if
+    trialPoolSize is set, otherwise starts a new userTrial in a new Process.
+    Then starts async listeners for sending and recieving messages. If the
+    participant disconnects before the userTrial is done, the userTrial is
+    stopped and its last upload requests are handled before its pipe is
+    closed.
     '''
-    upPipe, downPipe = Pipe()
-    userTrial = Process(target=Trial, args=(downPipe,))
-    userTrial.start()
-    consumerTask = asyncio.ensure_future(consumer_handler(websocket, upPipe))
-    producerTask = asyncio.ensure_future(producer_handler(websocket, upPipe))
+    config = load_config()
+    if hosts:
+        worker = hosts.acquire()
+    elif pool:
+        worker = pool.acquire()
+    else:
+        worker = TrialWorker(config)
+    queue = asyncio.Queue()
+    consumerTask = asyncio.ensure_future(consumer_handler(websocket, worker.pipe))
+    producerTask = asyncio.ensure_future(producer_handler(websocket, worker.pipe, worker.ring, config.get('adaptiveBitrate'), queue))
     done, pending = await asyncio.wait(
         [consumerTask, producerTask],
         return_when = asyncio.FIRST_COMPLETED
     )
     for task in pending:
         task.cancel()
+    if pending:
+        await asyncio.wait(pending)
     await websocket.close()
+    if producerTask.cancelled() or producerTask.exception() or not producerTask.result():
+        await end_trial(worker.pipe, queue)
+    worker.close()
     return
 
 async def consumer_handler(websocket, pipe):
@@ -54,52 +93,262 @@ async def consumer_handler(websocket, pipe):
     async for message in websocket:
         pipe.send(message)
 
-async def producer_handler(websocket, pipe):
+async def producer_handler(websocket, pipe, ring=None, reportQueue=False, queue=None):
     '''
-    Loop to call producer for messages to send from userTrial process.
-    Note that asyncio.sleep() is required to make this non-blocking
-    default sleep time is (0.01) which creates a maximum framerate of 
-    just under 100 frames/s. For faster framerates decrease sleep time
-    however be aware that this will affect the ability of the
-    consumer_handler function to keep up with messages from the websocket
-    and may cause poor performance if the web-client is sending a high volume
-    of messages.
+    Forwards messages from the userTrial process to the websocket as soon as
+    they arrive. The pipe's file descriptor is registered with the event loop
+    so that no polling is required; pipe_reader() moves incoming messages onto
+    an asyncio.Queue which this coroutine drains. Messages left in the queue
+    when it stops are handled by end_trial().
+    If reportQueue is set (adaptiveBitrate), the depth of the send queue is
+    reported back to the userTrial at most every QUEUE_REPORT_INTERVAL seconds.
+    Returns True once the userTrial is done, False if its pipe closed first.
     '''
-    done = False
-    while True:
-        done = await producer(websocket, pipe)
-        await asyncio.sleep(0.01)
-    return
+    loop = asyncio.get_event_loop()
+    if queue is None:
+        queue = asyncio.Queue()
+    loop.add_reader(pipe.fileno(), pipe_reader, pipe, queue)
+    lastReport = loop.time()
+    try:
+        while True:
+            message = await queue.get()
+            if message is None:
+                break
+            resume_reader(pipe, queue)
+            if await producer(websocket, message, pipe, ring):
+                return True
+            if reportQueue and loop.time() - lastReport >= QUEUE_REPORT_INTERVAL:
+                lastReport = loop.time()
+                report_queue(websocket, pipe, queue, ring)
+    finally:
+        loop.remove_reader(pipe.fileno())
+    return False
+
+async def end_trial(pipe, queue):
+    '''
+    Stops a userTrial whose participant has disconnected and handles its
+    messages until it is done, so that the log files it closes are uploaded
+    and its archive is completed. Frames are dropped. Gives up after
+    END_TRIAL_TIMEOUT seconds, leaving the userTrial to close itself when its
+    pipe is closed.
+    '''
+    try:
+        pipe.send(json.dumps({'command': 'stop'}))
+    except (BrokenPipeError, OSError):
+        pass # exited already, its remaining messages are in the queue
+    loop = asyncio.get_event_loop()
+    loop.add_reader(pipe.fileno(), pipe_reader, pipe, queue)
+    deadline = loop.time() + END_TRIAL_TIMEOUT
+    try:
+        while True:
+            message = await asyncio.wait_for(queue.get(), deadline - loop.time())
+            if message is None or message == 'done':
+                return
+            resume_reader(pipe, queue)
+            if isinstance(message, dict) and 'upload' in message:
+                await upload_to_s3(message)
+    except asyncio.TimeoutError:
+        logging.warning(f'Trial did not stop within {END_TRIAL_TIMEOUT}s of its participant disconnecting')
+    finally:
+        loop.remove_reader(pipe.fileno())
+
+def report_queue(websocket, pipe, queue, ring=None):
+    '''
+    Tells the userTrial how many messages are waiting to be sent to the
+    websocket, how many bytes are buffered in the websocket transport and
+    how many frames have been dropped from the shared memory ring so far.
+    '''
+    buffered = websocket.transport.get_write_buffer_size() if websocket.transport else 0
+    dropped = ring.dropped if ring else 0
+    try:
+        pipe.send(json.dumps({'sendQueue': {'messages': queue.qsize(), 'bytes': buffered, 'dropped': dropped}}))
+    except (BrokenPipeError, OSError):
+        pass
 
-async def producer(websocket, pipe):
+def pipe_reader(pipe, queue):
     '''
-    Check userTrial process pipe for messages to send to websocket.
+    Event loop callback for when the userTrial pipe becomes readable. Reads
+    every message currently waiting so one wakeup can carry several frames.
+    Once MAX_QUEUED_MESSAGES are waiting to be sent, reading stops until
+    resume_reader() sees the queue drain, leaving further messages in the
+    pipe, so a slow websocket fills the pipe's buffer and blocks the
+    userTrial rather than the communicator's memory.
+    Once the userTrial process has exited the pipe reports EOF and None is
+    queued to stop producer_handler.
+    '''
+    try:
+        while queue.qsize() < MAX_QUEUED_MESSAGES and pipe.poll():
+            queue.put_nowait(pipe.recv())
+    except (EOFError, OSError):
+        asyncio.get_event_loop().remove_reader(pipe.fileno())
+        queue.put_nowait(None)
+        return
+    if queue.qsize() >= MAX_QUEUED_MESSAGES:
+        asyncio.get_event_loop().remove_reader(pipe.fileno())
+
+def resume_reader(pipe, queue):
+    '''
+    Called after taking a message from the queue. Starts pipe_reader() again
+    once a full queue has drained to half of MAX_QUEUED_MESSAGES.
+    '''
+    if queue.qsize() == MAX_QUEUED_MESSAGES // 2:
+        asyncio.get_event_loop().add_reader(pipe.fileno(), pipe_reader, pipe, queue)
+
+async def producer(websocket, message, pipe, ring=None):
+    '''
+    Sends a message from the userTrial process to the websocket.
     If userTrial is done, send final message to websocket and return
-    True to tell calling functions that userTrial is complete.
+    True, which stops producer_handler.
+    Binary frames (bytes) are sent as binary websocket messages.
     '''
-    if pipe.poll():
-        message = pipe.recv()
-        if message == 'done':
-            await websocket.send('done')
-            return True
-        elif 'upload' in message:
-            await upload_to_s3(message)
-        else:
-            await websocket.send(message)
+    if isinstance(message, bytes):
+        await websocket.send(message)
+    elif isinstance(message, dict) and 'frameSlot' in message:
+        await send_from_ring(websocket, ring, message['frameSlot'], pipe)
+    elif message == 'done':
+        await websocket.send('done')
+        return True
+    elif 'upload' in message:
+        await upload_to_s3(message)
+    else:
+        await websocket.send(message)
     return False
 
+async def send_from_ring(websocket, ring, seq:int, pipe):
+    '''
+    Sends the frame in slot seq of the shared memory ring to the websocket
+    without copying it out of shared memory first, then releases the slot.
+    Frames that have fallen too far behind the userTrial are dropped, and the
+    userTrial is asked for a keyframe so delta encoded streams recover.
+    '''
+    if ring.is_stale(seq):
+        if ring.release(seq, dropped=True):
+            pipe.send(json.dumps({'requestKeyframe': True}))
+        return
+    frame, binary = ring.read(seq)
+    if frame is None:
+        return
+    try:
+        if binary:
+            await websocket.send(frame)
+        else:
+            await websocket.send(str(frame, 'utf-8'))
+    finally:
+        frame.release()
+        ring.release(seq)
+
 async def upload_to_s3(message):
     global devEnv
     logging.info(devEnv)
     if devEnv:
         logging.info('Dev set... Not uploading to s3.')
         return
-    file = message['upload']['file']
-    path = message['upload']['path']
     projectId = message['upload']['projectId']
     userId = message['upload']['userId']
     bucket = message['upload']['bucket']
-    Process(target=Uploader, args=(projectId, userId, file, path, bucket)).start()
+    if message['upload'].get('finish'):
+        uploads.finish_archive(projectId, userId, message['upload']['archive'], bucket)
+        return
+    file = message['upload']['file']
+    path = message['upload']['path']
+    if message['upload'].get('archive'):
+        uploads.append_to_archive(projectId, userId, message['upload']['archive'], file, path, bucket)
+    else:
+        uploads.submit(projectId, userId, file, path, bucket)
+
+def benchmark_trial(pipe, messages:int, framerate:int, frameSize:int):
+    '''
+    Process target standing in for a userTrial: once told to start, sends
+    messages binary frames of frameSize bytes at framerate, each starting
+    with the time it was sent, then 'done'.
+    '''
+    payload = bytes(frameSize)
+    pipe.recv()
+    start = time.time()
+    for i in range(messages):
+        time.sleep(max(0.0, start + i / framerate - time.time()))
+        pipe.send(struct.pack('!d', time.time()) + payload)
+    pipe.send('done')
+
+class BenchmarkSocket():
+    '''
+    Stands in for a participant's websocket, recording how long each frame
+    took to get from the userTrial to websocket.send().
+    '''
+    transport = None
+
+    def __init__(self):
+        self.latencies = []
+
+    async def send(self, message):
+        if isinstance(message, bytes):
+            self.latencies.append(time.time() - struct.unpack_from('!d', message)[0])
+
+async def polling_producer_handler(websocket, pipe):
+    '''
+    The producer_handler of earlier versions, for comparison in benchmark():
+    polls the pipe and forwards at most one message every 0.01 seconds.
+    Unlike the original it stops once the userTrial is done.
+    '''
+    while True:
+        if pipe.poll() and await producer(websocket, pipe.recv(), pipe):
+            return True
+        await asyncio.sleep(0.01)
+
+def benchmark(connections:int=50, messages:int=300, framerate:int=30, frameSize:int=20000, polling:bool=False):
+    '''
+    Drives connections userTrial stand ins, each in its own process, through
+    producer_handler at once, or polling_producer_handler with polling set.
+    Returns the latency of each frame from the
+    userTrial's pipe.send() to websocket.send() in milliseconds (mean, p50,
+    p99, max), and the communicator's cpu time per message in microseconds
+    and as a fraction of one core.
+    '''
+    pipes = []
+    processes = []
+    for i in range(connections):
+        pipe, childPipe = Pipe()
+        process = Process(target=benchmark_trial, args=(childPipe, messages, framerate, frameSize), daemon=True)
+        process.start()
+        childPipe.close()
+        pipes.append(pipe)
+        processes.append(process)
+    sockets = [BenchmarkSocket() for pipe in pipes]
+
+    async def run():
+        handler = polling_producer_handler if polling else producer_handler
+        tasks = [asyncio.ensure_future(handler(socket, pipe)) for socket, pipe in zip(sockets, pipes)]
+        for pipe in pipes:
+            pipe.send('start')
+        return await asyncio.gather(*tasks)
+
+    start = time.perf_counter()
+    cpuStart = time.process_time()
+    finished = asyncio.get_event_loop().run_until_complete(run())
+    cpu = time.process_time() - cpuStart
+    elapsed = time.perf_counter() - start
+    for process in processes:
+        process.join()
+    latencies = sorted(1000 * latency for socket in sockets for latency in socket.latencies)
+    return {
+        'connections': connections,
+        'finished': sum(finished),
+        'messages': len(latencies),
+        'meanMs': sum(latencies) / len(latencies),
+        'p50Ms': latencies[len(latencies) // 2],
+        'p99Ms': latencies[int(len(latencies) * 0.99)],
+        'maxMs': latencies[-1],
+        'cpuUsPerMessage': 1e6 * cpu / len(latencies),
+        'cpuCores': cpu / elapsed
+    }
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'benchmark':
+        for polling in (True, False):
+            results = benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 50, polling=polling)
+            print('polling every 0.01s:' if polling else 'event loop reader:')
+            print(f'  {results["finished"]}/{results["connections"]} connections finished, {results["messages"]} messages')
+            print(f'  latency: mean {results["meanMs"]:.2f} ms, p50 {results["p50Ms"]:.2f} ms, p99 {results["p99Ms"]:.2f} ms, max {results["maxMs"]:.2f} ms')
+            print(f'  cpu: {results["cpuUsPerMessage"]:.1f} us per message, {results["cpuCores"]:.2f} cores')
+    else:
+        main()
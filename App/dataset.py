@@ -0,0 +1,201 @@
+'''
+Offline access to the step logs in a Trials/ directory, for analysis, replay
+and offline training:
+    dataset = TrialDataset('Trials')
+    len(dataset)                 # steps in every log file
+    dataset.rewards              # npArray of every step's reward
+    dataset.episode(3)           # columns of the 4th episode
+    dataset.observation(100000)  # one observation, read from disk
+    dataset.batch(np.random.randint(len(dataset), size=64))
+
+Columnar log files (dataFormat columnar) are memory-mapped in place. Pickle
+log files are converted once into columnar files in a .cache directory next
+to them, so later opens memory-map the cache rather than unpickling every
+entry again. Observations are never all loaded: they are read from the
+memory-mapped files when accessed.
+
+Episodes are split at steps whose done column is set, so trial files
+(dataFile trial) give one episode per environment episode. An episode cut
+short by the end of a file counts as an episode.
+'''
+import os, logging
+import numpy as np
+from trajectory import MAGIC, COLUMNS, ColumnarReader, ColumnarWriter, read_pickle_log
+
+SKIPPED_PREFIXES = ('.', 'episodes_user_') # hidden files and the local copies of trial archives (see archive.py)
+SKIPPED_SUFFIXES = ('.partial', '.state', '.tmp', '.failed', '.json')
+
+class TrialDataset():
+    '''
+    An index of the episodes and steps of the log files in a directory.
+    Steps are numbered across all files in filename order. actionSpace, the
+    trial config's list of actions, is used to rebuild humanAction for pickle
+    logs, which record the participant's action messages but not the action
+    number.
+    '''
+
+    def __init__(self, directory:str='Trials', actionSpace:list=None, chunkSize:int=1024):
+        self.directory = directory
+        self.actionSpace = actionSpace
+        self.chunkSize = chunkSize
+        self.cacheDir = os.path.join(directory, '.cache')
+        self.files = []
+        self.readers = []
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if name.startswith(SKIPPED_PREFIXES) or name.endswith(SKIPPED_SUFFIXES) or not os.path.isfile(path):
+                continue
+            try:
+                reader = ColumnarReader(self.columnar_path(path))
+            except Exception:
+                logging.exception(f'Skipping unreadable log file {path}')
+                continue
+            self.files.append(name)
+            self.readers.append(reader)
+        self.fileStarts = np.cumsum([0] + [len(reader) for reader in self.readers])
+        self.steps = int(self.fileStarts[-1])
+        self.columns = {}
+        self.episodeStarts = self.find_episodes()
+
+    def columnar_path(self, path:str):
+        '''
+        Returns a columnar version of a log file: the file itself, or its
+        conversion in the cache directory, made if missing or out of date.
+        '''
+        with open(path, 'rb') as infile:
+            if infile.read(len(MAGIC)) == MAGIC:
+                return path
+        cachePath = os.path.join(self.cacheDir, os.path.basename(path))
+        if os.path.exists(cachePath) and os.path.getmtime(cachePath) >= os.path.getmtime(path):
+            return cachePath
+        os.makedirs(self.cacheDir, exist_ok=True)
+        tempPath = cachePath + '.tmp'
+        writer = ColumnarWriter(open(tempPath, 'wb'), self.chunkSize)
+        try:
+            humanAction = 0
+            for entry in read_pickle_log(path):
+                action = entry.get('action')
+                if self.actionSpace and isinstance(action, str) and action:
+                    action = action.strip().lower()
+                    humanAction = self.actionSpace.index(action) if action in self.actionSpace else 0
+                writer.write(entry, humanAction=humanAction if self.actionSpace else None, timestamp=np.nan)
+            writer.close()
+        except BaseException:
+            writer.outfile.close()
+            os.remove(tempPath)
+            raise
+        os.replace(tempPath, cachePath)
+        return cachePath
+
+    def find_episodes(self):
+        starts = []
+        for start, reader in zip(self.fileStarts, self.readers):
+            if not len(reader):
+                continue
+            ends = np.flatnonzero(reader.column('done'))
+            starts.append(start)
+            starts.extend(start + ends[ends < len(reader) - 1] + 1)
+        return np.array(starts + [self.steps], dtype=np.int64)
+
+    def __len__(self):
+        return self.steps
+
+    @property
+    def episodes(self):
+        return len(self.episodeStarts) - 1
+
+    def column(self, name:str):
+        '''
+        Returns one of the fixed columns (see trajectory.COLUMNS) for every
+        step of every file. Built once and cached.
+        '''
+        if name not in self.columns:
+            arrays = [reader.column(name) for reader in self.readers]
+            dtype = dict((column[0], column[1]) for column in COLUMNS)[name]
+            self.columns[name] = np.concatenate(arrays) if arrays else np.zeros(0, dtype=dtype)
+        return self.columns[name]
+
+    @property
+    def rewards(self):
+        return self.column('reward')
+
+    @property
+    def actions(self):
+        return self.column('agentAction')
+
+    @property
+    def humanActions(self):
+        return self.column('humanAction')
+
+    @property
+    def timestamps(self):
+        return self.column('timestamp')
+
+    @property
+    def dones(self):
+        return self.column('done')
+
+    @property
+    def episodeIds(self):
+        '''
+        The episode number of every step.
+        '''
+        return np.repeat(np.arange(self.episodes), np.diff(self.episodeStarts))
+
+    def episode(self, index:int):
+        '''
+        Returns the step range and the column views of one episode.
+        '''
+        start, end = int(self.episodeStarts[index]), int(self.episodeStarts[index + 1])
+        episode = {'start': start, 'end': end}
+        for name, dtype, missing in COLUMNS:
+            episode[name] = self.column(name)[start:end]
+        return episode
+
+    def locate(self, step:int):
+        '''
+        Returns (reader, step within the reader's file) for a step number.
+        '''
+        if step < 0:
+            step += self.steps
+        if not 0 <= step < self.steps:
+            raise IndexError(step)
+        file = int(np.searchsorted(self.fileStarts, step, side='right')) - 1
+        return self.readers[file], step - int(self.fileStarts[file])
+
+    def observation(self, step:int):
+        reader, index = self.locate(step)
+        return reader.observation(index)
+
+    def observations(self, steps):
+        '''
+        Returns the observations of several steps stacked into one npArray.
+        '''
+        return np.stack([self.observation(int(step)) for step in steps])
+
+    def iter_observations(self):
+        '''
+        Yields every observation in step order, one chunk in memory at a time.
+        '''
+        for reader in self.readers:
+            yield from reader.iter_observations()
+
+    def batch(self, steps):
+        '''
+        Returns the columns and observations of the given steps, for example
+        a random minibatch for offline training.
+        '''
+        steps = np.asarray(steps)
+        batch = {name: self.column(name)[steps] for name, dtype, missing in COLUMNS}
+        batch['observation'] = self.observations(steps)
+        return batch
+
+    def close(self):
+        '''
+        Closes the log files. Observations and columns still referenced keep
+        their file's memory map open until they are freed.
+        '''
+        self.columns = {}
+        for reader in self.readers:
+            reader.close()
+        self.readers = []
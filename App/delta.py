@@ -0,0 +1,145 @@
+'''
+Changed-region (delta) frame encoding for renders that change little from one
+frame to the next, such as Atari games.
+
+Frames are split into square tiles. A keyframe carries the whole frame, a
+delta frame carries only the tiles that differ from the previous frame. Both
+are lossless and zlib compressed, so the decoder reproduces every frame
+exactly. A keyframe is sent every keyframeInterval frames, whenever the frame
+shape changes, and after reset() (e.g. when a frame was dropped on the way to
+the client).
+
+Payload layout (network byte order):
+    PAYLOAD_HEADER: height (uint16), width (uint16), channels (uint8),
+                    tileSize (uint8), number of tiles (uint32)
+    zlib compressed body:
+        keyframe:    the full frame, uint8, row major
+        delta frame: tile indices (uint16 * number of tiles) followed by the
+                     tiles, each tileSize x tileSize x channels uint8
+Tiles are numbered row major over the frame padded up to a multiple of
+tileSize.
+
+DeltaDecoder is the reference implementation of the decoder for clients.
+'''
+import struct, zlib
+import numpy as np
+
+KEY_FRAME = 1
+DELTA_FRAME = 2
+PAYLOAD_HEADER = struct.Struct('!HHBBI')
+
+def to_tiles(frame, tileSize:int):
+    '''
+    Returns a (tilesHigh, tilesWide, tileSize, tileSize, channels) view of a
+    contiguous frame whose height and width are multiples of tileSize.
+    Writing to the view writes to the frame.
+    '''
+    height, width, channels = frame.shape
+    tiles = frame.reshape(height // tileSize, tileSize, width // tileSize, tileSize, channels)
+    return tiles.swapaxes(1, 2)
+
+def pad_frame(frame, tileSize:int):
+    '''
+    Pads a frame with zeros so its height and width are multiples of tileSize,
+    and gives greyscale frames a channel axis.
+    '''
+    if frame.ndim == 2:
+        frame = frame[:, :, None]
+    height, width = frame.shape[:2]
+    padHeight = -height % tileSize
+    padWidth = -width % tileSize
+    if padHeight or padWidth:
+        frame = np.pad(frame, ((0, padHeight), (0, padWidth), (0, 0)))
+    return np.ascontiguousarray(frame, dtype=np.uint8)
+
+class DeltaEncoder():
+    '''
+    Encodes a sequence of frames as keyframes and changed-tile delta frames.
+    '''
+
+    def __init__(self, tileSize:int=16, keyframeInterval:int=60, level:int=1):
+        self.tileSize = tileSize
+        self.keyframeInterval = keyframeInterval
+        self.level = level
+        self.previous = None
+        self.shape = None
+        self.sinceKeyframe = 0
+
+    def reset(self):
+        '''
+        Forces the next frame to be a keyframe.
+        '''
+        self.previous = None
+
+    def encode(self, frame):
+        '''
+        Encodes a frame (height x width x channels uint8 npArray).
+        Returns (frameType, payload) where frameType is KEY_FRAME or DELTA_FRAME.
+        '''
+        shape = frame.shape
+        padded = pad_frame(frame, self.tileSize)
+        height, width, channels = shape[0], shape[1], padded.shape[2]
+        if (self.previous is None or shape != self.shape
+                or self.sinceKeyframe >= self.keyframeInterval):
+            self.previous = padded
+            self.shape = shape
+            self.sinceKeyframe = 1
+            header = PAYLOAD_HEADER.pack(height, width, channels, self.tileSize, 0)
+            return KEY_FRAME, header + zlib.compress(padded[:height, :width].tobytes(), self.level)
+
+        current = to_tiles(padded, self.tileSize)
+        changed = np.flatnonzero((current != to_tiles(self.previous, self.tileSize)).any(axis=(2, 3, 4)))
+        rows, cols = np.divmod(changed, current.shape[1])
+        self.previous = padded
+        self.sinceKeyframe += 1
+        header = PAYLOAD_HEADER.pack(height, width, channels, self.tileSize, len(changed))
+        body = changed.astype('>u2').tobytes() + current[rows, cols].tobytes()
+        return DELTA_FRAME, header + zlib.compress(body, self.level)
+
+class DeltaDecoder():
+    '''
+    Reference decoder: rebuilds frames from the payloads of DeltaEncoder.
+    '''
+
+    def __init__(self):
+        self.frame = None
+
+    def decode(self, frameType:int, payload:bytes):
+        '''
+        Returns the decoded frame as a height x width x channels uint8 npArray.
+        '''
+        height, width, channels, tileSize, count = PAYLOAD_HEADER.unpack_from(payload)
+        body = zlib.decompress(payload[PAYLOAD_HEADER.size:])
+        if frameType == KEY_FRAME:
+            frame = np.frombuffer(body, dtype=np.uint8).reshape(height, width, channels)
+            self.frame = pad_frame(frame, tileSize)
+        elif frameType == DELTA_FRAME:
+            if self.frame is None:
+                raise ValueError('Delta frame received before a keyframe')
+            indices = np.frombuffer(body, dtype='>u2', count=count).astype(np.intp)
+            tiles = np.frombuffer(body, dtype=np.uint8, offset=2 * count)
+            self.frame = self.frame.copy()
+            view = to_tiles(self.frame, tileSize)
+            rows, cols = np.divmod(indices, view.shape[1])
+            view[rows, cols] = tiles.reshape(count, tileSize, tileSize, channels)
+        else:
+            raise ValueError(f'Unknown frame type {frameType}')
+        return self.frame[:height, :width]
+
+def verify_round_trip(frames, **encoderArgs):
+    '''
+    Test harness: encodes then decodes a sequence of frames and checks every
+    decoded frame is identical to the original. Returns the total encoded size
+    in bytes and the total raw size, raises AssertionError on a mismatch.
+    '''
+    encoder = DeltaEncoder(**encoderArgs)
+    decoder = DeltaDecoder()
+    encodedBytes = rawBytes = 0
+    for i, frame in enumerate(frames):
+        frameType, payload = encoder.encode(frame)
+        decoded = decoder.decode(frameType, payload)
+        expected = frame if frame.ndim == 3 else frame[:, :, None]
+        assert np.array_equal(decoded, expected), f'Frame {i} does not round-trip'
+        encodedBytes += len(payload)
+        rawBytes += frame.nbytes
+    return encodedBytes, rawBytes
@@ -0,0 +1,98 @@
+'''
+A ring buffer of (action, tiles, timestamp) experiences for the human
+feedback agents (tamerAgent.py, coachAgent.py), indexed by timestamp so the
+experiences a piece of feedback refers to are found by binary search rather
+than by scanning from the oldest:
+    experiences = ExperienceBuffer(maxSize=1000)
+    experiences.append((action, tiles, time.time()))
+    experiences.evict_before(time.time() - window_size)
+    credited = experiences.window(feedbackTime - 2, feedbackTime - 0.2)
+Appending and evicting are O(1), timestamp lookups O(log n). When the buffer
+is full the oldest experience is dropped for the new one.
+'''
+import numpy as np
+
+class ExperienceBuffer():
+    '''
+    Experiences, oldest first, with non-decreasing timestamps: an experience
+    whose timestamp (its last item) is earlier than the newest one's, for
+    example after a system clock change, is indexed at the newest timestamp.
+    '''
+
+    def __init__(self, maxSize:int=1000):
+        if maxSize < 1:
+            raise ValueError(f'maxSize must be at least 1, not {maxSize}')
+        self.maxSize = maxSize
+        self.items = [None] * maxSize
+        self.timestamps = np.zeros(maxSize)
+        self.start = 0 # slot of the oldest experience
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index:int):
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError('experience index out of range')
+        return self.items[(self.start + index) % self.maxSize]
+
+    def __iter__(self):
+        for index in range(self.size):
+            yield self.items[(self.start + index) % self.maxSize]
+
+    def append(self, experience):
+        timestamp = experience[-1]
+        if self.size:
+            timestamp = max(timestamp, self.timestamps[(self.start + self.size - 1) % self.maxSize])
+        if self.size == self.maxSize:
+            self.evict(1)
+        slot = (self.start + self.size) % self.maxSize
+        self.items[slot] = experience
+        self.timestamps[slot] = timestamp
+        self.size += 1
+
+    def index(self, timestamp:float, side:str='left'):
+        '''
+        Returns the number of experiences before timestamp (side left), or
+        at or before it (side right), by binary search.
+        '''
+        end = self.start + self.size
+        if end <= self.maxSize:
+            return int(np.searchsorted(self.timestamps[self.start:end], timestamp, side))
+        # the buffer wraps around: two sorted runs, slots start.. then 0..
+        older = self.timestamps[self.start:]
+        index = int(np.searchsorted(older, timestamp, side))
+        if index < len(older):
+            return index
+        return len(older) + int(np.searchsorted(self.timestamps[:end - self.maxSize], timestamp, side))
+
+    def window(self, start:float, end:float):
+        '''
+        Returns the experiences with start <= timestamp < end, oldest first.
+        '''
+        return [self[index] for index in range(self.index(start), self.index(end))]
+
+    def evict(self, count:int):
+        '''
+        Drops the oldest count experiences.
+        '''
+        count = max(0, min(count, self.size))
+        self.start = (self.start + count) % self.maxSize
+        self.size -= count
+
+    def evict_before(self, timestamp:float):
+        '''
+        Drops the experiences older than timestamp.
+        '''
+        self.evict(self.index(timestamp))
+
+    def popleft(self):
+        experience = self[0]
+        self.evict(1)
+        return experience
+
+    def clear(self):
+        self.start = 0
+        self.size = 0
@@ -0,0 +1,176 @@
+'''
+Frame codecs used by Trial.get_render to turn the npArray returned by
+Agent.render() into the bytes sent to the participant's browser.
+
+The codec is selected from the trial section of config.yml:
+    frameEncoding: jpeg, png, webp or delta
+    frameQuality: jpeg/webp quality 1-95
+    frameScale: downscale factor, 2 halves the width and height
+    frameGrayscale: True to send single channel frames
+
+Every codec returns (frameType, bytes); the frame type tells the client how
+to decode the frame (see FRAME_TYPES). Image codecs reuse one BytesIO across
+frames rather than allocating a new buffer per frame.
+
+Run this file with a .npy file of recorded renders (frames x height x width
+x 3) to compare the encode time and size of each codec:
+    python3 framecodec.py frames.npy
+'''
+import sys, time
+import numpy as np
+from PIL import Image
+from io import BytesIO
+from delta import DeltaEncoder, KEY_FRAME, DELTA_FRAME
+
+JPEG_FRAME = 0
+PNG_FRAME = 3
+WEBP_FRAME = 4
+FRAME_TYPES = {
+    JPEG_FRAME: 'jpeg',
+    KEY_FRAME: 'delta keyframe',
+    DELTA_FRAME: 'delta',
+    PNG_FRAME: 'png',
+    WEBP_FRAME: 'webp'
+}
+
+class FrameCodec():
+    '''
+    Base class for frame codecs. Subclasses implement encode_image().
+    '''
+    name = None
+    frameType = None
+    format = None
+
+    def __init__(self, quality:int=75, scale:float=1, grayscale:bool=False):
+        self.quality = quality
+        self.scale = scale
+        self.grayscale = grayscale
+        self.buffer = BytesIO()
+
+    def prepare(self, render):
+        '''
+        Applies the downscale and grayscale settings. Returns a PIL Image.
+        '''
+        img = Image.fromarray(render)
+        if self.scale != 1:
+            size = (max(1, round(img.width / self.scale)), max(1, round(img.height / self.scale)))
+            img = img.resize(size, Image.BILINEAR)
+        if self.grayscale:
+            img = img.convert('L')
+        return img
+
+    def encode(self, render):
+        '''
+        Encodes a render npArray. Returns (frameType, bytes).
+        '''
+        return self.frameType, self.encode_image(self.prepare(render))
+
+    def encode_image(self, img):
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        img.save(self.buffer, self.format, **self.save_args())
+        return self.buffer.getvalue()
+
+    def save_args(self):
+        return {}
+
+    def reset(self):
+        '''
+        Called when the client may have missed frames. Stateless codecs ignore it.
+        '''
+        pass
+
+class JpegCodec(FrameCodec):
+    name = 'jpeg'
+    frameType = JPEG_FRAME
+    format = 'JPEG'
+
+    def save_args(self):
+        return {'quality': self.quality}
+
+class PngCodec(FrameCodec):
+    name = 'png'
+    frameType = PNG_FRAME
+    format = 'PNG'
+
+    def save_args(self):
+        return {'compress_level': 1}
+
+class WebpCodec(FrameCodec):
+    name = 'webp'
+    frameType = WEBP_FRAME
+    format = 'WEBP'
+
+    def save_args(self):
+        return {'quality': self.quality, 'method': 0}
+
+class DeltaCodec(FrameCodec):
+    '''
+    Lossless changed-tile encoding, see delta.py.
+    '''
+    name = 'delta'
+
+    def __init__(self, quality:int=75, scale:float=1, grayscale:bool=False, tileSize:int=16, keyframeInterval:int=60):
+        super().__init__(quality, scale, grayscale)
+        self.encoder = DeltaEncoder(tileSize, keyframeInterval)
+
+    def encode(self, render):
+        if self.scale != 1 or self.grayscale:
+            render = np.asarray(self.prepare(render))
+        return self.encoder.encode(render)
+
+    def reset(self):
+        self.encoder.reset()
+
+CODECS = {codec.name: codec for codec in (JpegCodec, PngCodec, WebpCodec, DeltaCodec)}
+
+def get_codec(config:dict):
+    '''
+    Builds the codec described by the trial config.
+    '''
+    name = config.get('frameEncoding', 'jpeg')
+    if name not in CODECS:
+        raise ValueError(f'Unknown frameEncoding {name}, expected one of {list(CODECS)}')
+    args = {
+        'quality': config.get('frameQuality', 75),
+        'scale': config.get('frameScale', 1),
+        'grayscale': config.get('frameGrayscale', False)
+    }
+    if name == 'delta':
+        args['tileSize'] = config.get('deltaTileSize', 16)
+        args['keyframeInterval'] = config.get('keyframeInterval', 60)
+    return CODECS[name](**args)
+
+def benchmark(frames, codecs:list):
+    '''
+    Encodes every frame with each codec. Returns a list of dictionaries with
+    the mean encode time (ms) and mean size (bytes) per frame for each codec.
+    '''
+    results = []
+    for codec in codecs:
+        size = 0
+        start = time.perf_counter()
+        for frame in frames:
+            size += len(codec.encode(frame)[1])
+        elapsed = time.perf_counter() - start
+        results.append({
+            'codec': codec.name,
+            'quality': codec.quality,
+            'scale': codec.scale,
+            'grayscale': codec.grayscale,
+            'msPerFrame': 1000 * elapsed / len(frames),
+            'bytesPerFrame': size / len(frames)
+        })
+    return results
+
+if __name__ == '__main__':
+    frames = np.load(sys.argv[1])
+    codecs = [
+        JpegCodec(quality=75), JpegCodec(quality=50), JpegCodec(quality=75, scale=2),
+        JpegCodec(quality=75, grayscale=True), PngCodec(), WebpCodec(quality=75),
+        DeltaCodec(), DeltaCodec(scale=2)
+    ]
+    print(f'{len(frames)} frames of shape {frames.shape[1:]}')
+    print(f'{"codec":8} {"quality":>7} {"scale":>5} {"gray":>5} {"ms/frame":>9} {"bytes/frame":>12}')
+    for row in benchmark(frames, codecs):
+        print(f'{row["codec"]:8} {row["quality"]:>7} {row["scale"]:>5} {str(row["grayscale"]):>5} {row["msPerFrame"]:>9.3f} {row["bytesPerFrame"]:>12.0f}')
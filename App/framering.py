@@ -0,0 +1,140 @@
+import struct
+try:
+    from multiprocessing import shared_memory
+except ImportError: # shared_memory requires python 3.8+, frames then fall back to the Pipe
+    shared_memory = None
+
+# Ring header: head (next sequence number the Trial will write), tail (next
+# sequence number the communicator has not yet released), slots, slotSize
+RING_HEADER = struct.Struct('=QQII')
+RING_HEADER_SIZE = 64
+# Slot header: payload length, binary flag
+SLOT_HEADER = struct.Struct('=IB')
+SLOT_HEADER_SIZE = 8
+
+def available():
+    '''
+    Returns True if multiprocessing.shared_memory can be used on this python.
+    '''
+    return shared_memory is not None
+
+class FrameRing():
+    '''
+    A bounded single-producer single-consumer ring buffer of encoded frames in
+    shared memory. The Trial process writes frames into slots and sends only
+    the sequence number over its Pipe; the communicator reads the frame
+    straight out of shared memory and releases the slot once it has been
+    handed to the websocket.
+
+    The Trial only ever writes head and the communicator only ever writes
+    tail, so no locking is needed. A slot is never overwritten before the
+    communicator has released it: if the ring is full, write() refuses the
+    frame (back-pressure) and the Trial drops it. The communicator in turn
+    drops the oldest queued frames when it falls more than maxLag frames
+    behind the Trial, so participants always see the most recent frames.
+    '''
+
+    def __init__(self, memory, owner=False):
+        self.memory = memory
+        self.owner = owner
+        self.name = memory.name
+        self.buffer = memory.buf
+        _, _, self.slots, self.slotSize = RING_HEADER.unpack_from(self.buffer, 0)
+        self.stride = SLOT_HEADER_SIZE + self.slotSize
+        self.maxLag = max(1, self.slots // 2)
+        self.overflows = 0
+        self.dropped = 0
+        self.lastDropped = None
+
+    @classmethod
+    def create(cls, slots:int=8, slotSize:int=262144):
+        '''
+        Creates a new ring in shared memory. Called by the communicator, which
+        owns the ring and unlinks it when the connection closes.
+        '''
+        size = RING_HEADER_SIZE + slots * (SLOT_HEADER_SIZE + slotSize)
+        memory = shared_memory.SharedMemory(create=True, size=size)
+        RING_HEADER.pack_into(memory.buf, 0, 0, 0, slots, slotSize)
+        return cls(memory, owner=True)
+
+    @classmethod
+    def attach(cls, name:str):
+        '''
+        Attaches to an existing ring by name. Called in the Trial process.
+        '''
+        return cls(shared_memory.SharedMemory(name=name))
+
+    @property
+    def head(self):
+        return struct.unpack_from('=Q', self.buffer, 0)[0]
+
+    @property
+    def tail(self):
+        return struct.unpack_from('=Q', self.buffer, 8)[0]
+
+    def write(self, *chunks, binary:bool=True):
+        '''
+        Writes the concatenation of chunks into the next free slot and returns
+        its sequence number. Returns None if the frame does not fit in a slot
+        or if the ring is full.
+        '''
+        length = sum(len(chunk) for chunk in chunks)
+        if length > self.slotSize:
+            return None
+        head = self.head
+        if head - self.tail >= self.slots:
+            self.overflows += 1
+            return None
+        offset = RING_HEADER_SIZE + (head % self.slots) * self.stride
+        SLOT_HEADER.pack_into(self.buffer, offset, length, binary)
+        offset += SLOT_HEADER_SIZE
+        for chunk in chunks:
+            self.buffer[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+        struct.pack_into('=Q', self.buffer, 0, head + 1)
+        return head
+
+    def read(self, seq:int):
+        '''
+        Returns (memoryview, binary) for the frame with sequence number seq
+        without copying it, or (None, None) if the frame has already been
+        released or dropped. The memoryview must be released, and the slot
+        released with release(), once the frame has been sent.
+        '''
+        if seq < self.tail:
+            return None, None
+        offset = RING_HEADER_SIZE + (seq % self.slots) * self.stride
+        length, binary = SLOT_HEADER.unpack_from(self.buffer, offset)
+        offset += SLOT_HEADER_SIZE
+        return self.buffer[offset:offset + length], bool(binary)
+
+    def is_stale(self, seq:int):
+        '''
+        Returns True if the consumer is so far behind that frame seq should be
+        dropped in favour of newer frames.
+        '''
+        return self.head - 1 - seq >= self.maxLag
+
+    def release(self, seq:int, dropped:bool=False):
+        '''
+        Marks every frame up to and including seq as consumed, freeing the
+        slots for the producer. When dropping, returns True if seq starts a
+        new run of dropped frames.
+        '''
+        if seq >= self.tail:
+            struct.pack_into('=Q', self.buffer, 8, seq + 1)
+        if dropped:
+            self.dropped += 1
+            newRun = self.lastDropped != seq - 1
+            self.lastDropped = seq
+            return newRun
+        return False
+
+    def close(self):
+        '''
+        Detaches from the shared memory, and removes it if this is the owner.
+        '''
+        self.buffer = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
@@ -0,0 +1,176 @@
+'''
+Background thread for a Trial's step log files. Creating files, serializing
+entries, writing, fsync and closing all happen on the thread, so a slow disk
+(the network backed storage of a Fargate task) delays the log rather than
+the participant's frames.
+
+The Trial hands jobs to the thread through a bounded queue, in order: open a
+file, write a step, close the file. If the disk falls so far behind that the
+queue is full, the Trial waits for room rather than holding an unbounded
+backlog of observations in memory; such waits are counted in stats().
+
+Closed files are listed in LogWriter.completed for the Trial to upload from
+its own thread, as the Pipe to the communicator is not thread safe.
+'''
+import logging, os, queue, threading, time
+from collections import deque
+from multiprocessing import util
+from trajectory import get_writer
+
+class LogWriter():
+    '''
+    Runs the log writers selected by dataFormat (see trajectory.py) on a
+    background thread:
+        logWriter.open('Trials/trial_x.partial', 'Trials/trial_x')
+        logWriter.write(entry, frameId, humanAction)
+        logWriter.close_file(('trial_x', 'Trials/trial_x'))
+        logWriter.close()
+    Entries must not be modified once passed to write().
+    If the process exits without close() being called, for example when the
+    Trial raises, the queued steps are still written and the open file is
+    flushed and synced to disk, but not renamed or listed as completed.
+    '''
+
+    def __init__(self, config:dict, maxQueue:int=1024):
+        self.config = config
+        self.queue = queue.Queue(maxQueue)
+        self.completed = deque()
+        self.writer = None
+        self.path = None
+        self.finalPath = None
+        self.closed = False
+        self.jobs = 0
+        self.writeTime = 0.0
+        self.maxWriteTime = 0.0
+        self.maxQueueDepth = 0
+        self.blocked = 0
+        self.blockedTime = 0.0
+        self.errors = 0
+        self.thread = threading.Thread(target=self.run, name='LogWriter', daemon=True)
+        self.thread.start()
+        # multiprocessing runs its finalizers when a Trial process exits, even
+        # after an exception, where atexit handlers would not run
+        self.finalizer = util.Finalize(self, self.close, exitpriority=10)
+
+    def open(self, path:str, finalPath:str=None):
+        '''
+        Starts a new log file at path, renamed to finalPath once closed. If
+        finalPath exists, from an earlier session of the same participant,
+        the log is continued from it rather than replaced.
+        '''
+        self.put(('open', path, finalPath))
+
+    def write(self, entry:dict, frameId:int=None, humanAction:int=None):
+        '''
+        Queues a step for the open log file. The timestamp is taken now.
+        '''
+        self.put(('write', entry, frameId, humanAction, time.time()))
+
+    def close_file(self, tag=None):
+        '''
+        Closes the open log file. tag is added to self.completed once the
+        file is closed, synced and renamed.
+        '''
+        self.put(('close', tag))
+
+    def put(self, job:tuple):
+        if self.closed:
+            raise ValueError('LogWriter is closed')
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            start = time.perf_counter()
+            self.queue.put(job)
+            self.blocked += 1
+            self.blockedTime += time.perf_counter() - start
+        self.maxQueueDepth = max(self.maxQueueDepth, self.queue.qsize())
+
+    def run(self):
+        '''
+        The background thread. Runs jobs in order until close().
+        '''
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            start = time.perf_counter()
+            try:
+                self.run_job(job)
+            except Exception:
+                self.errors += 1
+                if self.errors <= 10:
+                    logging.exception(f'Log writer failed on {job[0]} for {self.path}')
+            elapsed = time.perf_counter() - start
+            self.jobs += 1
+            self.writeTime += elapsed
+            self.maxWriteTime = max(self.maxWriteTime, elapsed)
+        if self.writer:
+            self.finish_file() # left open by a trial that did not finish
+
+    def run_job(self, job:tuple):
+        kind = job[0]
+        if kind == 'open':
+            if self.writer:
+                self.finish_file()
+            self.path, self.finalPath = job[1], job[2]
+            if self.finalPath and os.path.exists(self.finalPath):
+                self.continue_final()
+            self.writer = get_writer(self.config, self.path)
+        elif kind == 'write':
+            _, entry, frameId, humanAction, timestamp = job
+            if self.writer:
+                self.writer.write(entry, frameId, humanAction, timestamp)
+        elif kind == 'close':
+            if self.writer:
+                self.finish_file()
+                if self.finalPath:
+                    os.replace(self.path, self.finalPath)
+                self.completed.append(job[1])
+
+    def continue_final(self):
+        '''
+        Moves the finished log of an earlier session back to path, where the
+        writer appends to it. If path exists too, left by a session that did
+        not finish, that is appended to instead and the finished log is
+        moved aside, as the two can not be joined.
+        '''
+        if not os.path.exists(self.path):
+            os.replace(self.finalPath, self.path)
+            return
+        aside = f'{self.finalPath}.{int(time.time())}'
+        logging.warning(f'{self.path} and {self.finalPath} both exist, moving {self.finalPath} to {aside}')
+        os.replace(self.finalPath, aside)
+
+    def finish_file(self):
+        '''
+        Writes out anything the writer has buffered, syncs the file to disk
+        and closes it.
+        '''
+        writer, self.writer = self.writer, None
+        writer.flush()
+        writer.outfile.flush()
+        os.fsync(writer.outfile.fileno())
+        writer.close()
+
+    def close(self):
+        '''
+        Waits for every queued job to finish and stops the thread.
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        self.finalizer.cancel()
+        self.queue.put(None)
+        self.thread.join()
+
+    def stats(self):
+        return {
+            'queueDepth': self.queue.qsize(),
+            'maxQueueDepth': self.maxQueueDepth,
+            'jobs': self.jobs,
+            'meanWriteMs': 1000 * self.writeTime / self.jobs if self.jobs else 0.0,
+            'maxWriteMs': 1000 * self.maxWriteTime,
+            'blockedWrites': self.blocked,
+            'blockedMs': 1000 * self.blockedTime,
+            'errors': self.errors
+        }
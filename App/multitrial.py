@@ -0,0 +1,287 @@
+'''
+Multi-trial-per-process mode. With trialsPerProcess > 1 in the trial config,
+participants share host processes, each running up to trialsPerProcess
+Trial instances on one cooperative scheduler. This saves the memory of a
+python interpreter and gym import per participant. It suits cheap
+environments such as the classic control games used by tamerAgent.py and
+coachAgent.py; an expensive environment will slow every trial in its host.
+
+The communicator starts hosts as needed. For each new connection it creates
+a Pipe, sends the child end's file descriptor to a host over the host's
+control Pipe, and the host builds a Trial around it. Each Trial keeps its own
+FrameScheduler and is ticked when its own frame deadline comes up.
+
+With batchSteps set, trials whose deadlines fall within batchWindow seconds
+of each other are ticked together, like a vector environment: each trial
+still handles its own messages, actions, resets and logging, but the renders
+of the batch are taken in one call to the Agent class's render_batch(agents)
+and the steps in one call to its step_batch(agents, actions), when the Agent
+provides them (see agent.py), so a vectorised environment can advance every
+trial with one operation. Without them the trials are rendered and stepped
+one after another, which still saves a wake-up of the host per trial. Trials
+ticked early join the cadence of the batch, so trials at the same frame rate
+stay in the same batch.
+
+Hosts are started from the forkserver of pool.trial_context(), so a host
+started later does not inherit the communicator's ends of the Pipes of trials
+on earlier hosts, which would keep those trials from seeing EOF when their
+participants disconnect.
+
+Run this file from the App directory, with a .trialConfig.yml, to compare the
+memory used per participant by hosted trials and by a process per trial:
+    python3 multitrial.py 40 10
+'''
+import logging, sys, time
+from multiprocessing import Pipe
+from multiprocessing.connection import Connection, wait
+from multiprocessing.reduction import send_handle, recv_handle
+from trial import DISCONNECTED, Trial
+from pool import create_ring, trial_context, TrialWorker
+
+def host_trials(control, batchWindow:float=None):
+    '''
+    Process target for a trial host. Accepts new trials from the control
+    Pipe and ticks every trial on its frame deadline, sleeping until the
+    earliest deadline or the next control message. With batchWindow set,
+    ticks every trial due within batchWindow seconds together (see 
+    tick_batch()). Exits when the communicator closes the control Pipe.
+    '''
+    trials = []
+    while True:
+        while control.poll():
+            try:
+                ringName = control.recv()
+                pipe = Connection(recv_handle(control))
+            except EOFError:
+                for trial in trials:
+                    trial.pipe.close()
+                return
+            try:
+                trials.append(Trial(pipe, ringName, autoRun=False))
+            except Exception:
+                logging.exception('Failed to start hosted trial')
+                pipe.close()
+
+        if batchWindow is None:
+            for trial in trials:
+                if trial.scheduler.remaining() > 0:
+                    continue
+                try:
+                    trial.tick()
+                    trial.scheduler.advance()
+                except Exception:
+                    fail_trial(trial, log_failure(trial))
+        elif any(trial.scheduler.remaining() == 0 for trial in trials):
+            batch = [trial for trial in trials if trial.scheduler.due(batchWindow)]
+            for trial, disconnected in tick_batch(batch).items():
+                fail_trial(trial, disconnected)
+            for trial in batch:
+                trial.scheduler.advance()
+
+        for trial in [trial for trial in trials if trial.done]:
+            trials.remove(trial)
+            trial.pipe.close() # the communicator sees EOF, as when a trial process exits
+
+        timeout = min((trial.scheduler.remaining() for trial in trials), default=None)
+        wait([control], timeout)
+
+def log_failure(trial):
+    '''
+    Logs the exception being handled for a hosted trial. Returns True if
+    the participant disconnected, the communicator having closed the trial's
+    Pipe, which is not an error.
+    '''
+    if isinstance(sys.exc_info()[1], DISCONNECTED):
+        logging.info(f'Hosted trial {trial.trialId} disconnected')
+        return True
+    logging.exception(f'Hosted trial {trial.trialId} failed')
+    return False
+
+def fail_trial(trial, disconnected:bool=False):
+    '''
+    Ends a trial whose tick raised, keeping the steps it logged. Unless its
+    participant disconnected, the trial is ended as usual, so its log files
+    are still uploaded.
+    '''
+    try:
+        if disconnected:
+            trial.close()
+        else:
+            trial.end()
+    except Exception:
+        if not log_failure(trial):
+            logging.error(f'Hosted trial {trial.trialId} could not be ended')
+        trial.close()
+
+def tick_batch(trials:list):
+    '''
+    Ticks trials together, doing for each what Trial.tick() does, but
+    rendering every playing trial and then stepping every playing trial
+    through run_batch(). Returns the trials that failed, which are left out
+    of the rest of the tick, as a dictionary of whether each disconnected 
+    (see log_failure()).
+    '''
+    failed = {}
+    playing = [trial for trial in trials if attempt(trial, failed, trial.start_tick)]
+    rendering = [trial for trial in playing if trial.scheduler.should_render()]
+    for trial, render in run_batch(rendering, failed, 'render_batch', (), lambda trial: trial.agent.render()):
+        attempt(trial, failed, trial.send_frame, render)
+    stepping = [trial for trial in playing if trial not in failed]
+    actions = [trial.humanAction for trial in stepping]
+    for trial, envState in run_batch(stepping, failed, 'step_batch', (actions,), lambda trial: trial.agent.step(trial.humanAction)):
+        attempt(trial, failed, trial.record_step, envState)
+    for trial in trials:
+        if trial not in failed:
+            attempt(trial, failed, trial.finish_tick)
+    return failed
+
+def attempt(trial, failed:dict, function, *args):
+    '''
+    Returns function(*args), or None after adding trial to failed if it
+    raises.
+    '''
+    try:
+        return function(*args)
+    except Exception:
+        failed[trial] = log_failure(trial)
+        return None
+
+def run_batch(trials:list, failed:dict, method:str, args:tuple, single):
+    '''
+    Returns (trial, result) pairs for trials: the results of one call to
+    the Agent class's method(agents, *args) if it has one, or else of
+    single(trial) for each trial. Trials whose call raised are added to
+    failed, and if the batch call raises, every trial in the batch is.
+    '''
+    if not trials:
+        return []
+    batch = getattr(type(trials[0].agent), method, None)
+    if batch is None:
+        results = []
+        for trial in trials:
+            try:
+                results.append((trial, single(trial)))
+            except Exception:
+                failed[trial] = log_failure(trial)
+        return results
+    try:
+        return list(zip(trials, batch([trial.agent for trial in trials], *args)))
+    except Exception:
+        logging.exception(f'Agent.{method} failed for {len(trials)} hosted trials')
+        failed.update((trial, False) for trial in trials)
+        return []
+
+class HostedTrial():
+    '''
+    The communicator's handle on a trial running in a TrialHost. Has the
+    same pipe, ring and close() interface as pool.TrialWorker.
+    '''
+
+    def __init__(self, host, config:dict):
+        self.host = host
+        self.ring = create_ring(config)
+        self.pipe, childPipe = Pipe()
+        host.control.send(self.ring.name if self.ring else None)
+        send_handle(host.control, childPipe.fileno(), host.process.pid)
+        childPipe.close()
+        host.active += 1
+
+    def close(self):
+        if self.ring:
+            logging.info(f'Frames dropped from shared memory ring: {self.ring.dropped}')
+            self.ring.close()
+            self.ring = None
+        self.pipe.close()
+        self.host.active -= 1
+
+class TrialHost():
+    '''
+    A host process running many trials.
+    '''
+
+    def __init__(self, context, batchWindow:float=None):
+        self.control, childControl = Pipe()
+        self.process = context.Process(target=host_trials, args=(childControl, batchWindow))
+        self.process.start()
+        childControl.close()
+        self.active = 0
+
+class TrialHosts():
+    '''
+    Places each new trial on the least loaded host with room for it,
+    starting a new host when every host is full.
+    '''
+
+    def __init__(self, config:dict, trialsPerProcess:int):
+        self.config = config
+        self.trialsPerProcess = trialsPerProcess
+        self.batchWindow = config.get('batchWindow', 0.005) if config.get('batchSteps') else None
+        self.hosts = []
+        self.context = trial_context()
+
+    def acquire(self):
+        '''
+        Starts a trial on a host and returns its HostedTrial.
+        '''
+        for host in [host for host in self.hosts if not host.process.is_alive()]:
+            logging.warning(f'Trial host exited with code {host.process.exitcode}')
+            host.control.close()
+            self.hosts.remove(host)
+        available = [host for host in self.hosts if host.active < self.trialsPerProcess]
+        if available:
+            host = min(available, key=lambda host: host.active)
+        else:
+            host = TrialHost(self.context, self.batchWindow)
+            self.hosts.append(host)
+            logging.info(f'Started trial host {len(self.hosts)}')
+        return HostedTrial(host, self.config)
+
+def memory(pid:int):
+    '''
+    Returns the proportional set size of a process in bytes, which shares
+    out pages shared between processes, or its resident set size where
+    that is not available.
+    '''
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as infile:
+            return sum(int(line.split()[1]) * 1024 for line in infile if line.startswith('Pss:'))
+    except OSError:
+        with open(f'/proc/{pid}/status') as infile:
+            return sum(int(line.split()[1]) * 1024 for line in infile if line.startswith('VmRSS:'))
+
+def benchmark(participants:int=40, trialsPerProcess:int=10, settle:float=5.0):
+    '''
+    Starts participants trials on TrialHosts with trialsPerProcess trials
+    each, and then as many TrialWorkers with a process each, waits settle
+    seconds for the environments to start, and returns the memory used in
+    each mode and the participants that fit in a GB. Trials are started but
+    not played, so the figures are for the interpreter, gym and the
+    environments. Linux only.
+    '''
+    from trial import load_config
+    config = load_config()
+    results = {}
+    hosts = TrialHosts(config, trialsPerProcess)
+    handles = [hosts.acquire() for i in range(participants)]
+    time.sleep(settle)
+    results['hosted'] = sum(memory(host.process.pid) for host in hosts.hosts)
+    for handle in handles:
+        handle.close()
+    for host in hosts.hosts:
+        host.control.close()
+        host.process.join()
+    workers = [TrialWorker(config) for i in range(participants)]
+    time.sleep(settle)
+    results['process'] = sum(memory(worker.process.pid) for worker in workers)
+    for worker in workers:
+        worker.close()
+        worker.process.join()
+    return {mode: {'bytes': size, 'bytesPerParticipant': size / participants, 'participantsPerGB': participants * 2**30 / size}
+            for mode, size in results.items()}
+
+if __name__ == '__main__':
+    from multitrial import benchmark # so the hosts' target is multitrial.host_trials rather than __main__'s
+    participants = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    trialsPerProcess = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    for mode, result in benchmark(participants, trialsPerProcess).items():
+        print(f'{mode:8} {result["bytes"] / 2**20:10.1f} MB {result["bytesPerParticipant"] / 2**20:8.2f} MB/participant {result["participantsPerGB"]:8.1f} participants/GB')
@@ -0,0 +1,111 @@
+import asyncio, logging, multiprocessing
+from collections import deque
+from multiprocessing import Pipe
+from trial import Trial
+import framering
+
+def create_ring(config:dict):
+    '''
+    Creates the shared memory frame ring for a new userTrial if enabled in
+    the trial config. Returns None if disabled or not supported by this
+    version of python, in which case frames are sent through the Pipe.
+    '''
+    if not config.get('sharedMemoryFrames'):
+        return None
+    if not framering.available():
+        logging.warning('sharedMemoryFrames requires python 3.8+, sending frames through the Pipe.')
+        return None
+    return framering.FrameRing.create(config.get('frameRingSlots', 8), config.get('frameSlotSize', 262144))
+
+def trial_context():
+    '''
+    Returns the multiprocessing context trial processes are started from. A
+    process forked from the communicator would inherit its end of every Pipe
+    open at the time, the trial's own included, so the trial would not see
+    EOF when its connection closes. Processes are instead forked from a
+    forkserver, which preloads the main module, setting up logging as in the
+    communicator, and trial.py, so gym is still imported only once.
+    '''
+    context = multiprocessing.get_context('forkserver')
+    context.set_forkserver_preload(['__main__', 'trial'])
+    return context
+
+class TrialWorker():
+    '''
+    A userTrial running in its own Process, with the communicator's end of
+    its Pipe and its shared memory frame ring if enabled.
+    The Trial constructs its environment as soon as the process starts and
+    then waits for a participant's first message, so a started worker can be
+    handed to a new websocket connection at any time.
+    '''
+
+    def __init__(self, config:dict, warmUp:bool=False):
+        self.ring = create_ring(config)
+        self.pipe, childPipe = Pipe()
+        self.process = trial_context().Process(target=Trial, args=(childPipe, self.ring.name if self.ring else None, warmUp))
+        self.process.start()
+        childPipe.close() # the child holds its own copy, closing ours lets self.pipe see EOF when it exits
+
+    def close(self):
+        '''
+        Releases the communicator's resources for this worker once its
+        connection has closed.
+        '''
+        if self.ring:
+            logging.info(f'Frames dropped from shared memory ring: {self.ring.dropped}')
+            self.ring.close()
+            self.ring = None
+        self.pipe.close()
+
+class TrialPool():
+    '''
+    A pool of pre-started TrialWorkers so participants do not wait for
+    python, gym and the environment to load when they connect.
+    acquire() hands out an idle worker immediately and the pool is topped
+    back up in the background, one worker per event loop iteration so the
+    server stays responsive.
+    '''
+
+    def __init__(self, config:dict, size:int, warmUp:bool=True):
+        self.config = config
+        self.size = size
+        self.warmUp = warmUp
+        self.idle = deque()
+        self.refilling = False
+
+    def fill(self):
+        '''
+        Starts workers until the pool is full. Called once at server start.
+        '''
+        while len(self.idle) < self.size:
+            self.idle.append(TrialWorker(self.config, self.warmUp))
+        logging.info(f'Trial pool started with {self.size} workers')
+
+    def acquire(self):
+        '''
+        Returns an idle worker, or a new one if the pool is empty.
+        '''
+        worker = None
+        while self.idle and worker is None:
+            worker = self.idle.popleft()
+            if not worker.process.is_alive():
+                logging.warning(f'Discarding pooled trial that exited with code {worker.process.exitcode}')
+                worker.close()
+                worker = None
+        if worker is None:
+            worker = TrialWorker(self.config)
+        self.schedule_refill()
+        return worker
+
+    def schedule_refill(self):
+        if not self.refilling:
+            self.refilling = True
+            asyncio.get_event_loop().call_soon(self.refill)
+
+    def refill(self):
+        if len(self.idle) < self.size:
+            self.idle.append(TrialWorker(self.config, self.warmUp))
+        if len(self.idle) < self.size:
+            asyncio.get_event_loop().call_soon(self.refill)
+        else:
+            self.refilling = False
@@ -1,5 +1,12 @@
-import boto3
+import boto3, json, logging, os, random, time, shortuuid
+from boto3.s3.transfer import TransferConfig
+from boto3.exceptions import Boto3Error
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Process, Queue
 from dotenv import load_dotenv
+from archive import TrialArchive
 
 load_dotenv()
 
@@ -13,4 +20,191 @@ class Uploader:
         key = self.key + file
         self.s3.meta.client.upload_file(path, bucket, key)
 
+class UploadService():
+    '''
+    One long lived upload process for the container, started by the
+    communicator, in place of an Uploader process per file.
+    Every upload is first written as a job file in queueDir, and removed once
+    the file is in s3, so uploads interrupted by a restart of the container
+    are picked up again when the next UploadService starts. Up to 'workers'
+    files are uploaded at a time through one pooled s3 client, files larger
+    than multipartChunkSize in concurrent multipart parts. Failed uploads
+    are retried with exponential backoff, up to 'retries' times, after which
+    the job file is renamed to .failed and left for inspection.
+    With archiveEpisodes set, episode files are instead appended to a
+    per-trial archive (see archive.py), uploaded in multipart parts as it
+    grows. Archive jobs run one at a time, in the order they were submitted.
+    Archives left unfinished by a trial that never asked for it, such as one
+    still running when the container stopped, are finished at startup.
+    '''
 
+    def __init__(self, queueDir:str='Trials/.uploads', workers:int=4, retries:int=5, multipartChunkSize:int=8388608, endpointUrl:str=None):
+        self.queueDir = queueDir
+        self.options = {
+            'workers': workers,
+            'retries': retries,
+            'multipartChunkSize': multipartChunkSize,
+            'endpointUrl': endpointUrl
+        }
+        os.makedirs(queueDir, exist_ok=True)
+        self.jobs = Queue()
+        self.process = Process(target=run_uploads, args=(self.jobs, queueDir, self.options), daemon=True)
+        self.process.start()
+
+    def submit(self, projectId, userId, file, path, bucket):
+        '''
+        Queues a file for upload to s3 at {projectId}/Trials/{userId}/{file}.
+        '''
+        self.queue_job({'type': 'file', 'path': path, 'bucket': bucket, 'key': f'{projectId}/Trials/{userId}/{file}'})
+
+    def append_to_archive(self, projectId, userId, archive, file, path, bucket):
+        '''
+        Queues a file to be appended to the archive uploaded to s3 at
+        {projectId}/Trials/{userId}/{archive}.
+        '''
+        self.queue_job({'type': 'append', 'archive': archive, 'file': file, 'path': path, 'bucket': bucket,
+                        'key': f'{projectId}/Trials/{userId}/{archive}'})
+
+    def finish_archive(self, projectId, userId, archive, bucket):
+        '''
+        Queues the completion of an archive once every file is appended.
+        '''
+        self.queue_job({'type': 'finish', 'archive': archive, 'bucket': bucket,
+                        'key': f'{projectId}/Trials/{userId}/{archive}'})
+
+    def queue_job(self, job:dict):
+        self.jobs.put(write_job(self.queueDir, job))
+
+def write_job(queueDir:str, job:dict):
+    '''
+    Writes a job file to queueDir and returns its name, which is also
+    stored in the job as its id.
+    '''
+    name = f'{time.time():.6f}_{shortuuid.uuid()}.json'
+    tempPath = os.path.join(queueDir, name + '.tmp')
+    with open(tempPath, 'w') as outfile:
+        json.dump(dict(job, id=name[:-len('.json')]), outfile)
+    os.replace(tempPath, os.path.join(queueDir, name))
+    return name
+
+def run_uploads(jobs, queueDir:str, options:dict):
+    '''
+    Process target for the UploadService. Resumes the jobs left in queueDir
+    and finishes the archives no resumed job finishes, then uploads each job
+    submitted until the communicator exits.
+    '''
+    client = boto3.client('s3', endpoint_url=options['endpointUrl'], config=Config(
+        max_pool_connections=options['workers'] * 10,
+        retries={'max_attempts': 3, 'mode': 'standard'}))
+    transferConfig = TransferConfig(
+        multipart_threshold=options['multipartChunkSize'],
+        multipart_chunksize=options['multipartChunkSize'],
+        max_concurrency=10)
+    executor = ThreadPoolExecutor(max_workers=options['workers'])
+    archiveExecutor = ThreadPoolExecutor(max_workers=1)
+    archives = {}
+    queued = set()
+
+    def job_done(name, future):
+        queued.discard(name)
+        if future.exception():
+            logging.error(f'Upload job {name} failed', exc_info=future.exception())
+
+    def submit(name):
+        if name in queued:
+            return
+        jobPath = os.path.join(queueDir, name)
+        try:
+            with open(jobPath) as infile:
+                job = json.load(infile)
+        except FileNotFoundError:
+            return # finished after being resumed at startup
+        except (OSError, ValueError):
+            logging.exception(f'Unreadable upload job {jobPath}')
+            return
+        queued.add(name)
+        if job.get('type', 'file') == 'file':
+            future = executor.submit(run_job, jobPath, job, options['retries'], upload_file, client, transferConfig)
+        else:
+            future = archiveExecutor.submit(run_job, jobPath, job, options['retries'], archive_job, client, archives, options['multipartChunkSize'])
+        future.add_done_callback(lambda future: job_done(name, future))
+        return job
+
+    resumed = sorted(name for name in os.listdir(queueDir) if name.endswith('.json'))
+    if resumed:
+        logging.info(f'Resuming {len(resumed)} uploads from {queueDir}')
+    unfinished = {} # archive: its resumed append job or saved state, either has its bucket and key
+    finishing = set()
+    for name in resumed:
+        job = submit(name)
+        if job and job.get('type') == 'append':
+            unfinished[job['archive']] = job
+        elif job and job.get('type') == 'finish':
+            finishing.add(job['archive'])
+    for name in os.listdir('Trials'):
+        if name.endswith('.state') and name[:-len('.state')] not in unfinished:
+            with open(os.path.join('Trials', name)) as infile:
+                unfinished[name[:-len('.state')]] = json.load(infile)
+    for archive in sorted(set(unfinished) - finishing):
+        logging.info(f'Finishing archive {archive}, left open by a trial that has stopped')
+        submit(write_job(queueDir, {'type': 'finish', 'archive': archive,
+                                    'bucket': unfinished[archive]['bucket'], 'key': unfinished[archive]['key']}))
+    while True:
+        submit(jobs.get())
+
+def run_job(jobPath:str, job:dict, retries:int, function, *args):
+    '''
+    Runs function(job, *args), retrying s3 and file system errors with
+    exponential backoff and jitter. Other errors, such as an unreadable
+    archive, would fail again, so the job is renamed to .failed at once.
+    Removes the job file once it succeeds, then calls what function returned,
+    if anything, to clean up what the job must not outlive.
+    '''
+    for attempt in range(retries + 1):
+        try:
+            start = time.monotonic()
+            cleanup = function(job, *args)
+            logging.info(f'Upload job {job.get("type", "file")} {job.get("path") or job.get("archive")} to s3://{job["bucket"]}/{job["key"]} '
+                         f'done in {time.monotonic() - start:.2f}s after {attempt} retries')
+            os.remove(jobPath)
+            if cleanup:
+                cleanup()
+            return
+        except FileNotFoundError:
+            logging.error(f'Not uploading {job.get("path") or job.get("archive")}, the file no longer exists')
+            os.remove(jobPath)
+            return
+        except (Boto3Error, BotoCoreError, ClientError, OSError) as error:
+            if attempt == retries:
+                logging.error(f'Giving up on upload job {jobPath}: {error}')
+                os.replace(jobPath, jobPath[:-len('.json')] + '.failed')
+                return
+            delay = min(60, 2 ** attempt) * random.uniform(0.5, 1)
+            logging.warning(f'Upload job {jobPath} failed ({error}), retrying in {delay:.1f}s')
+            time.sleep(delay)
+        except Exception:
+            logging.exception(f'Upload job {jobPath} failed, not retrying')
+            os.replace(jobPath, jobPath[:-len('.json')] + '.failed')
+            return
+
+def upload_file(job:dict, client, transferConfig):
+    client.upload_file(job['path'], job['bucket'], job['key'], Config=transferConfig)
+
+def archive_job(job:dict, client, archives:dict, partSize:int):
+    '''
+    Appends a file to, or finishes, a TrialArchive. The local copy of the
+    archive is kept in the Trials directory. A finish returns the removal of
+    the archive's state, for run_job to call once the job file is removed.
+    '''
+    localPath = os.path.join('Trials', job['archive'])
+    if localPath not in archives:
+        if job['type'] == 'finish' and not os.path.exists(localPath + '.state'):
+            logging.warning(f'Not finishing archive {job["archive"]}, it has no state, so nothing was appended or it was finished already')
+            return None
+        archives[localPath] = TrialArchive(client, job['bucket'], job['key'], localPath, partSize)
+    if job['type'] == 'append':
+        archives[localPath].append(job['file'], job['path'], job.get('id'))
+        return None
+    archive = archives.pop(localPath)
+    archive.finish()
+    return archive.remove_state
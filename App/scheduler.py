@@ -0,0 +1,122 @@
+import time
+
+class FrameScheduler():
+    '''
+    Paces the Trial render-step loop against absolute frame deadlines on the
+    monotonic clock. Time spent rendering, encoding and stepping is taken out
+    of the wait rather than added on top of it, so the delivered frame rate
+    matches the requested one. When the loop falls behind, renders are
+    skipped (the environment still steps) and, if it falls too far behind,
+    missed deadlines are dropped so the loop does not try to catch up in a
+    burst. A frame counts as late, an overrun, once it is more than tolerance
+    (a fraction of the period) past its deadline, which leaves room for the
+    wake up latency of the sleep.
+    '''
+
+    def __init__(self, framerate:float, maxFrameSkip:int=2, tolerance:float=0.1):
+        self.maxFrameSkip = maxFrameSkip
+        self.tolerance = tolerance
+        self.frames = 0
+        self.overruns = 0
+        self.skippedRenders = 0
+        self.droppedFrames = 0
+        self.totalJitter = 0.0
+        self.maxJitter = 0.0
+        self.behind = 0
+        self.deadline = None
+        self.set_framerate(framerate)
+
+    def set_framerate(self, framerate:float):
+        '''
+        Changes the target frame rate. The next deadline is re-anchored to the
+        new period so a rate change takes effect on the following frame.
+        '''
+        self.framerate = framerate
+        self.period = 1/framerate
+        if self.deadline is not None:
+            self.deadline = time.monotonic() + self.period
+
+    def remaining(self):
+        '''
+        Returns the number of seconds until the next frame deadline, 0 if the
+        deadline has already passed.
+        '''
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.period
+        return max(0.0, self.deadline - time.monotonic())
+
+    def due(self, window:float=0.0):
+        '''
+        Returns True if the current frame deadline is at most window seconds
+        away. A deadline that has not passed yet is brought forward to now,
+        so the frame is run early but on time and later frames follow on
+        from it. Used to run the frames of trials that are due at nearly the
+        same time together (see multitrial.py).
+        '''
+        remaining = self.remaining()
+        if remaining > window:
+            return False
+        if remaining > 0:
+            self.deadline = time.monotonic()
+        return True
+
+    def should_render(self):
+        '''
+        Returns False if the loop is behind schedule and this frame's render
+        can be skipped. At least one frame in every maxFrameSkip + 1 is always
+        rendered.
+        '''
+        if self.behind and self.behind <= self.maxFrameSkip:
+            self.skippedRenders += 1
+            return False
+        self.behind = 0
+        return True
+
+    def wait(self):
+        '''
+        Sleeps until the current frame deadline and then advances to the next.
+        '''
+        delay = self.remaining()
+        if delay > 0:
+            time.sleep(delay)
+        self.advance()
+
+    def advance(self):
+        '''
+        Records the lateness of the current frame and moves the deadline on by
+        one period. Called by wait(), or directly by a caller that does its own
+        waiting (see remaining()).
+        '''
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.period
+        now = time.monotonic()
+        lateness = now - self.deadline
+        self.frames += 1
+        if lateness > 0:
+            self.totalJitter += lateness
+            self.maxJitter = max(self.maxJitter, lateness)
+        if lateness > self.tolerance * self.period:
+            self.overruns += 1
+            self.behind += 1
+            missed = int(lateness // self.period)
+            if missed > self.maxFrameSkip:
+                self.droppedFrames += missed
+                self.deadline = now
+        else:
+            self.behind = 0
+        self.deadline += self.period
+
+    def stats(self):
+        '''
+        Returns the per-trial timing statistics as a dictionary.
+        Jitter values are in seconds.
+        '''
+        return {
+            'framerate': self.framerate,
+            'frames': self.frames,
+            'overruns': self.overruns,
+            'skippedRenders': self.skippedRenders,
+            'droppedFrames': self.droppedFrames,
+            'meanJitter': self.totalJitter / self.frames if self.frames else 0.0,
+            'maxJitter': self.maxJitter
+        }
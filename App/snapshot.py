@@ -0,0 +1,231 @@
+'''
+Environment snapshots, to make resets cheaper and to rewind episodes. A
+SnapshotCache wraps the gym environment of an Agent (see agent.py):
+    self.snapshots = SnapshotCache(self.env, game)
+    observation = self.snapshots.reset()     # in place of self.env.reset()
+    self.snapshots.record(action, observation) # after each self.env.step()
+    observation = self.snapshots.rewind(k)   # back to step k of the episode
+    frame = self.snapshots.frame()           # if not None, in place of env.render()
+
+Atari environments (gym's AtariEnv, with the ALE clone_state() and
+restore_state() methods): the emulator state just after the first reset of
+a game is kept for the rest of the process, and later resets of any
+environment of that game restore it rather than run the ALE reset (emulator
+reset, noop frames and the rom's start actions). The random number
+generator is not part of the restored state, so sticky actions still differ
+between episodes. Environments with wrappers other than TimeLimit, whose
+reset() would be skipped, and non Atari environments, whose resets are
+usually cheap and random, are reset with env.reset(). Restoring an ALE state
+does not restore the screen, so the observation and frame of an ALE state
+are kept with it, and frame() returns the frame to render until the next
+step.
+
+For rewinding, a snapshot of the environment is taken every interval steps,
+including the random number generator so that replays are exact. rewind(k)
+restores the last snapshot at or before step k and replays the recorded
+actions from there to step k. At most maxSnapshots snapshots are kept per
+episode: when there are more, every other one is dropped and interval is
+doubled. Atari environments are snapshotted with the ALE full state, others
+by copying the attributes of the unwrapped environment, which is enough for
+pure python environments such as classic control. Environments that can not
+be copied can not be rewound. Wrappers other than TimeLimit keep their own
+state across a rewind.
+
+Run this file with an Atari game to measure reset and rewind latency:
+    python3 snapshot.py PongNoFrameskip-v4
+'''
+import bisect, copy, logging, time
+
+INITIAL_STATES = {} # game: (ALE state, observation, frame) after the first reset of the game in this process
+
+def wrappers(env):
+    '''
+    Yields the wrappers of env, outermost first.
+    '''
+    while env is not env.unwrapped:
+        yield env
+        env = env.env
+
+class SnapshotCache():
+    '''
+    Resets, and records and rewinds the episodes of, one environment.
+    interval 0 turns rewinding off.
+    '''
+
+    def __init__(self, env, game:str, interval:int=100, maxSnapshots:int=64):
+        self.env = env
+        self.game = game
+        self.unwrapped = env.unwrapped
+        self.ale = hasattr(self.unwrapped, 'clone_full_state')
+        self.cacheResets = self.ale and all(type(wrapper).__name__ == 'TimeLimit' for wrapper in wrappers(env))
+        self.baseInterval = interval
+        self.interval = interval
+        self.maxSnapshots = maxSnapshots
+        self.step = 0
+        self.actions = []
+        self.steps = [] # steps with a snapshot, ascending
+        self.snapshots = {}
+        self.restoredFrame = None # frame of a restored ALE state, until the next step
+        self.resets = 0
+        self.restoredResets = 0
+        self.resetTime = 0.0
+        self.rewinds = 0
+        self.rewindTime = 0.0
+
+    def reset(self):
+        '''
+        Resets the environment and returns the first observation.
+        '''
+        start = time.perf_counter()
+        if self.cacheResets and self.game in INITIAL_STATES:
+            state, observation, self.restoredFrame = INITIAL_STATES[self.game]
+            self.unwrapped.restore_state(state)
+            observation = observation.copy()
+            self.set_elapsed_steps(0)
+            self.restoredResets += 1
+        else:
+            observation = self.env.reset()
+            self.restoredFrame = None
+            if self.cacheResets:
+                INITIAL_STATES[self.game] = (self.unwrapped.clone_state(), observation.copy(), self.unwrapped.render('rgb_array'))
+        self.resets += 1
+        self.resetTime += time.perf_counter() - start
+        self.step = 0
+        self.actions = []
+        self.interval = self.baseInterval
+        self.steps = []
+        self.snapshots = {}
+        self.snapshot(observation)
+        return observation
+
+    def record(self, action, observation):
+        '''
+        Records the action of a step and the observation it returned.
+        '''
+        self.actions.append(action)
+        self.step += 1
+        self.restoredFrame = None
+        if self.interval and self.step % self.interval == 0:
+            self.snapshot(observation)
+
+    def snapshot(self, observation):
+        if not self.interval:
+            return
+        try:
+            if self.ale:
+                snapshot = (self.unwrapped.clone_full_state(), observation.copy(), self.unwrapped.render('rgb_array'))
+            else:
+                snapshot = copy.deepcopy((self.state(), observation))
+        except Exception:
+            logging.warning(f'{self.game} can not be snapshotted, rewinding is disabled')
+            self.baseInterval = self.interval = 0
+            return
+        self.steps.append(self.step)
+        self.snapshots[self.step] = snapshot
+        if len(self.steps) > self.maxSnapshots:
+            self.interval *= 2
+            self.steps = [step for step in self.steps if step % self.interval == 0]
+            self.snapshots = {step: self.snapshots[step] for step in self.steps}
+
+    def frame(self):
+        '''
+        Returns the frame to render in place of env.render('rgb_array') when
+        the screen of a restored ALE state is stale, None otherwise.
+        '''
+        return self.restoredFrame
+
+    def state(self):
+        return {key: value for key, value in vars(self.unwrapped).items() if key != 'viewer'}
+
+    def rewind(self, step:int):
+        '''
+        Returns the environment to the state it was in after the given step
+        of the current episode, and returns the observation of that step.
+        The steps after it are forgotten.
+        '''
+        if not self.interval:
+            raise ValueError(f'Rewinding is not available for {self.game}')
+        if not 0 <= step <= self.step:
+            raise ValueError(f'Can not rewind to step {step}, the episode is at step {self.step}')
+        start = time.perf_counter()
+        index = bisect.bisect_right(self.steps, step) - 1
+        snapshotStep = self.steps[index]
+        snapshot = self.snapshots[snapshotStep]
+        if self.ale:
+            state, observation, self.restoredFrame = snapshot
+            self.unwrapped.restore_full_state(state)
+            observation = observation.copy()
+        else:
+            state, observation = copy.deepcopy(snapshot)
+            vars(self.unwrapped).update(state)
+        self.set_elapsed_steps(snapshotStep)
+        replay = self.actions[snapshotStep:step]
+        self.actions = self.actions[:snapshotStep]
+        self.step = snapshotStep
+        for dropped in self.steps[index + 1:]:
+            del self.snapshots[dropped]
+        self.steps = self.steps[:index + 1]
+        for action in replay:
+            observation, reward, done, info = self.env.step(action)
+            self.record(action, observation)
+        self.rewinds += 1
+        self.rewindTime += time.perf_counter() - start
+        return observation
+
+    def set_elapsed_steps(self, steps:int):
+        for wrapper in wrappers(self.env):
+            if hasattr(wrapper, '_elapsed_steps'):
+                wrapper._elapsed_steps = steps
+
+    def stats(self):
+        '''
+        Returns reset and rewind counts and mean latencies as a dictionary.
+        '''
+        return {
+            'resets': self.resets,
+            'restoredResets': self.restoredResets,
+            'meanResetMs': 1000 * self.resetTime / self.resets if self.resets else 0.0,
+            'rewinds': self.rewinds,
+            'meanRewindMs': 1000 * self.rewindTime / self.rewinds if self.rewinds else 0.0,
+            'snapshots': len(self.steps),
+            'interval': self.interval
+        }
+
+def benchmark(make, game:str, resets:int=200, steps:int=1000):
+    '''
+    Times env.reset() against SnapshotCache.reset() on two environments
+    made with make(game), and rewinds to random steps of an episode of
+    random actions. Returns mean milliseconds.
+    '''
+    import random
+    env = make(game)
+    env.reset()
+    start = time.perf_counter()
+    for i in range(resets):
+        env.reset()
+    resetMs = 1000 * (time.perf_counter() - start) / resets
+    cache = SnapshotCache(make(game), game)
+    cache.reset() # fills INITIAL_STATES
+    start = time.perf_counter()
+    for i in range(resets):
+        cache.reset()
+    cachedMs = 1000 * (time.perf_counter() - start) / resets
+    cache.reset()
+    for i in range(steps):
+        action = cache.env.action_space.sample()
+        observation, reward, done, info = cache.env.step(action)
+        cache.record(action, observation)
+        if done:
+            break
+    start = time.perf_counter()
+    for i in range(20):
+        cache.rewind(random.randint(0, cache.step))
+    rewindMs = 1000 * (time.perf_counter() - start) / 20
+    return {'reset': resetMs, 'cachedReset': cachedMs, 'rewind': rewindMs}
+
+if __name__ == '__main__':
+    import sys, gym
+    results = benchmark(gym.make, sys.argv[1] if len(sys.argv) > 1 else 'PongNoFrameskip-v4')
+    print(f'env.reset(): {results["reset"]:.3f} ms')
+    print(f'SnapshotCache.reset(): {results["cachedReset"]:.3f} ms ({results["reset"] / results["cachedReset"]:.1f}x)')
+    print(f'SnapshotCache.rewind(): {results["rewind"]:.3f} ms')
@@ -8,6 +8,8 @@ import gym
 import time
 import numpy as np
 import itertools
+from tilecoding import TileCoder
+from experience import ExperienceBuffer
 
 
 #This is the code for tile coding features
@@ -97,6 +99,21 @@ class MountainCarTileCoder:
         self.iht = IHT(iht_size)
         self.num_tilings = num_tilings
         self.num_tiles = num_tiles
+        self.minP = -1.2
+        self.maxP = .5
+        self.minV = -.07
+        self.maxV = .07
+        # vectorised tiles(), dense over the whole state space (positions reach 0.6)
+        self.coder = TileCoder(self.iht, num_tilings, [0, 0], self.scale(np.array([0.6, self.maxV])))
+
+    def scale(self, states):
+        """
+            Scales positions and velocities (the last axis of states) to the
+            range [0, num_tiles]
+            """
+        low = np.array([self.minP, self.minV])
+        high = np.array([self.maxP, self.maxV])
+        return (states - low) / (high - low) * self.num_tiles
             
     def get_tiles(self, position, velocity):
         """
@@ -106,25 +123,19 @@ class MountainCarTileCoder:
             returns:
             tiles - np.array, active tiles
             """
-        # Use the ranges above and self.num_tiles to scale position and velocity to the range [0, 1]
-        # then multiply that range with self.num_tiles so it scales from [0, num_tiles]
-        minP=-1.2
-        maxP=.5
-        minV=-.07
-        maxV=.07
-        scaleP= maxP- minP
-        scaleV= maxV-minV
-        
-        position_scaled = ((position-minP)/(scaleP))*self.num_tiles
-        
-        velocity_scaled = ((velocity-minV)/(scaleV))*self.num_tiles
-        
-        
-        # get the tiles using tc.tiles, with self.iht, self.num_tilings and [scaled position, scaled velocity]
-        # nothing to implment here
-        mytiles = tiles(self.iht, self.num_tilings, [position_scaled, velocity_scaled])
-        
-        return np.array(mytiles)
+        # scale position and velocity to the range [0, num_tiles], then get the
+        # tiles of every tiling at once, the same tiles as
+        # tiles(self.iht, self.num_tilings, [scaled position, scaled velocity])
+        return self.coder.get_state_tiles([
+            (position - self.minP) / (self.maxP - self.minP) * self.num_tiles,
+            (velocity - self.minV) / (self.maxV - self.minV) * self.num_tiles])
+
+    def get_tiles_batch(self, states):
+        """
+            Takes an array of (position, velocity) states and returns an array
+            of the active tiles of each state, one row per state.
+            """
+        return self.coder.get_tiles(self.scale(np.asarray(states, dtype=np.float64)))
 
 
 #this is the tamer agent class
@@ -152,8 +163,9 @@ class TamerAgent:
         self.num_actions = 3
         self.actions = list(range(self.num_actions))
         self.time_step=0
-        self.experiences= list()
         self.max_n_experiences=1000
+        # ring buffer of (action, tiles, time), oldest first, searchable by time
+        self.experiences= ExperienceBuffer(self.max_n_experiences)
         self.window_size=1
         
         
@@ -254,18 +266,8 @@ class TamerAgent:
 
 
         current_time = time.time()
-        while len(self.experiences) > 0:
-            experience = self.experiences[0]
-            
-            #diff= current_time-experience[2]
-
-            #if (diff < .2 or diff > 2):
-            
-            if experience[2] < current_time - self.window_size: #
-                self.experiences.pop(0)
-            
-            else:
-                break
+        # drop the experiences older than window_size
+        self.experiences.evict_before(current_time - self.window_size)
 
 # update weights using Algorithm 1 in paper
         n_experiences = len(self.experiences)
@@ -273,17 +275,23 @@ class TamerAgent:
         if n_experiences== 0:
             return
         weight_per_experience = 1.0/n_experiences
-        cred_features = np.zeros((self.num_actions, self.iht_size))
-            
-        for experience in self.experiences:
-            exp_features= np.zeros((self.num_actions, self.iht_size))
-            exp_features[experience[0]][experience[1]]=1
-            
-            exp_features*=weight_per_experience
-            cred_features = np.add(cred_features, exp_features)
-            
-        error = r - self.w * cred_features
-        self.w += (.01*error*cred_features)
+
+        # Each experience credits weight_per_experience to the weights of its
+        # action and active tiles, so only those entries of w change. Index
+        # them as a flat (action * iht_size + tile) index instead of building a
+        # dense (num_actions, iht_size) array per experience.
+        features = np.array([experience[0] * self.iht_size + np.asarray(experience[1]) for experience in self.experiences])
+        # an experience credits a tile once, even if tiles collide in a full IHT
+        features.sort(axis=1)
+        repeated = np.zeros(features.shape, dtype=bool)
+        repeated[:, 1:] = features[:, 1:] == features[:, :-1]
+        features, positions = np.unique(features[~repeated], return_inverse=True)
+        cred_features = np.zeros(len(features))
+        np.add.at(cred_features, positions, weight_per_experience)
+
+        actions, tiles = np.divmod(features, self.iht_size)
+        error = r - self.w[actions, tiles] * cred_features
+        self.w[actions, tiles] += (.01*error*cred_features)
 
 
 # Original HIPPO Gym Agent
@@ -0,0 +1,187 @@
+'''
+Vectorised tile coding for the MountainCarTileCoder of tamerAgent.py and
+coachAgent.py. TileCoder computes the coordinates of every tiling at once,
+for one state or a batch of states, and returns the same tile indices as
+tiles() with the same IHT: tiles are numbered by the IHT in the order they
+are first seen, and each new tile is added to the IHT as tiles() would.
+
+When the grid of possible coordinates over [low, high] has at most
+maxDenseSize cells, a dense lookup table from grid cell to tile index is
+kept in front of the IHT, so a known tile costs one array lookup. Tiles
+outside the grid, or all tiles when the grid is too large, are looked up in
+the IHT by their coordinate tuple (the hashing fallback).
+
+Run this file to compare it with tiles() on random mountain car states:
+    python3 tilecoding.py
+'''
+import time
+import numpy as np
+from math import floor
+
+class TileCoder():
+    '''
+    Tile codes floats into numTilings tile indices, like
+        tiles(iht, numTilings, floats, ints)
+    low and high bound the floats for the dense lookup table; floats outside
+    them are still coded correctly, through the hashing fallback. iht is an
+    IHT, or an int to hash coordinates modulo that size.
+    '''
+
+    def __init__(self, iht, numTilings:int, low, high, ints=(), maxDenseSize:int=1 << 22):
+        self.iht = iht
+        self.numTilings = numTilings
+        self.ints = tuple(ints)
+        dims = len(low)
+        tilings = np.arange(numTilings)
+        # offset of dimension k in tiling t is t * (1 + 2k), as in tiles()
+        self.offsets = tilings[:, None] * (1 + 2 * np.arange(dims))[None, :]
+        qLow = np.floor(np.asarray(low, dtype=np.float64) * numTilings).astype(np.int64)
+        qHigh = np.floor(np.asarray(high, dtype=np.float64) * numTilings).astype(np.int64)
+        self.coordLow = qLow // numTilings
+        self.coordHigh = (qHigh + self.offsets.max(axis=0)) // numTilings
+        extent = self.coordHigh - self.coordLow + 1
+        self.table = None
+        if hasattr(iht, 'getindex') and numTilings * int(np.prod(extent)) <= maxDenseSize:
+            self.extent = extent
+            self.strides = np.concatenate([np.cumprod(extent[::-1])[::-1][1:], [1]])
+            self.tilingBase = tilings * int(np.prod(extent))
+            self.table = np.full(numTilings * int(np.prod(extent)), -1, dtype=np.int64)
+            # cellRows[k][q - qLow[k]] is the part of the cell of every tiling
+            # due to dimension k, for q = floor(float * numTilings) in
+            # [qLow, qHigh], so one state's cells are a sum of dims rows
+            self.qLow = qLow.tolist()
+            self.qSizes = (qHigh - qLow + 1).tolist()
+            self.cellRows = []
+            for k in range(dims):
+                q = np.arange(qLow[k], qHigh[k] + 1)
+                rows = ((q[:, None] + self.offsets[None, :, k]) // numTilings - self.coordLow[k]) * self.strides[k]
+                self.cellRows.append(rows + (self.tilingBase if k == 0 else 0))
+
+    def coordinates(self, floats):
+        '''
+        Returns the tile coordinates of a batch of states: an int array of
+        (states, numTilings, dims).
+        '''
+        q = np.floor(floats * self.numTilings).astype(np.int64)
+        return (q[:, None, :] + self.offsets[None, :, :]) // self.numTilings
+
+    def get_tiles(self, floats):
+        '''
+        Returns the tile indices of one state (floats of shape (dims,)) as an
+        array of numTilings, or of a batch of states (shape (states, dims))
+        as an array of (states, numTilings).
+        '''
+        floats = np.asarray(floats, dtype=np.float64)
+        if floats.ndim == 1:
+            return self.get_state_tiles(floats.tolist())
+        coords = self.coordinates(floats)
+        if self.table is None:
+            return self.lookup(coords, np.ones(coords.shape[:2], dtype=bool), np.zeros(coords.shape[:2], dtype=np.int64))
+        relative = coords - self.coordLow
+        inside = np.all((relative >= 0) & (relative < self.extent), axis=2)
+        cells = np.where(inside, self.tilingBase + relative @ self.strides, 0)
+        tiles = np.where(inside, self.table[cells], -1)
+        if not (tiles < 0).any():
+            return tiles
+        # look up, in the order tiles() would, the first occurrence of each
+        # new cell and every tile outside the grid
+        tiles, cells, inside, coords = tiles.ravel(), cells.ravel(), inside.ravel(), coords.reshape(-1, coords.shape[2])
+        new = np.flatnonzero((tiles < 0) & inside)
+        first = new[np.unique(cells[new], return_index=True)[1]]
+        looked = np.union1d(first, np.flatnonzero(~inside))
+        for position in looked.tolist():
+            tiling = position % self.numTilings
+            if inside[position]:
+                tiles[position] = self.table_lookup(coords[position], tiling, cells[position])
+            else:
+                tiles[position] = self.getindex((tiling,) + tuple(coords[position].tolist()) + self.ints)
+        repeated = np.setdiff1d(new, first, assume_unique=True)
+        tiles[repeated] = self.table[cells[repeated]]
+        for position in repeated[tiles[repeated] < 0].tolist(): # tiles the full IHT did not store
+            tiles[position] = self.getindex((position % self.numTilings,) + tuple(coords[position].tolist()) + self.ints)
+        return tiles.reshape(-1, self.numTilings)
+
+    def get_state_tiles(self, floats):
+        '''
+        get_tiles() for one state, a sequence of dims floats, with as few
+        array operations as possible.
+        '''
+        if self.table is not None:
+            q = [floor(f * self.numTilings) - low for f, low in zip(floats, self.qLow)]
+            if all(0 <= i < size for i, size in zip(q, self.qSizes)):
+                cells = self.cellRows[0][q[0]]
+                for k in range(1, len(q)):
+                    cells = cells + self.cellRows[k][q[k]]
+                tiles = self.table[cells]
+                if tiles.min() >= 0:
+                    return tiles
+                coords = self.coordinates(np.asarray(floats, dtype=np.float64)[None])[0]
+                for tiling in np.flatnonzero(tiles < 0).tolist():
+                    tiles[tiling] = self.table_lookup(coords[tiling], tiling, cells[tiling])
+                return tiles
+        coords = self.coordinates(np.asarray(floats, dtype=np.float64)[None])
+        return self.lookup(coords, np.ones((1, self.numTilings), dtype=bool), np.zeros((1, self.numTilings), dtype=np.int64))[0]
+
+    def getindex(self, key):
+        if hasattr(self.iht, 'getindex'):
+            return self.iht.getindex(key)
+        return hash(key) % self.iht
+
+    def table_lookup(self, coords, tiling:int, cell:int):
+        '''
+        Looks up a tile of the dense grid in the IHT and stores its index in
+        the table once the IHT has stored it.
+        '''
+        key = (int(tiling),) + tuple(coords.tolist()) + self.ints
+        index = self.iht.getindex(key)
+        if key in self.iht.dictionary:
+            self.table[cell] = index
+        return index
+
+    def lookup(self, coords, missing, tiles):
+        '''
+        The hashing fallback: looks up tiles by their coordinate tuple, in
+        the order tiles() would.
+        '''
+        tiles = tiles.copy()
+        for state, tiling in zip(*np.nonzero(missing)):
+            tiles[state, tiling] = self.getindex((int(tiling),) + tuple(coords[state, tiling].tolist()) + self.ints)
+        return tiles
+
+def benchmark(iht, tiles, numTilings:int=8, numTiles:int=8, states:int=10000, seed:int=0):
+    '''
+    Times tiles() against TileCoder on random mountain car states, scaled
+    as in MountainCarTileCoder, once every tile has been seen, and checks
+    both give the same indices.
+    Returns microseconds per state for tiles(), TileCoder one state at a time
+    and TileCoder on the whole batch.
+    '''
+    rng = np.random.RandomState(seed)
+    scaled = rng.uniform([0, 0], [numTiles * 1.8 / 1.7, numTiles], size=(states, 2))
+    reference = iht(4096)
+    coder = TileCoder(iht(4096), numTilings, [0, 0], [numTiles * 1.8 / 1.7, numTiles])
+    batchCoder = TileCoder(iht(4096), numTilings, [0, 0], [numTiles * 1.8 / 1.7, numTiles])
+    # the first pass fills the IHTs in the same order, the second is timed
+    for timed in (False, True):
+        start = time.perf_counter()
+        expected = np.array([tiles(reference, numTilings, list(state)) for state in scaled])
+        referenceTime = time.perf_counter() - start
+        start = time.perf_counter()
+        single = np.array([coder.get_tiles(state) for state in scaled])
+        singleTime = time.perf_counter() - start
+        start = time.perf_counter()
+        batch = batchCoder.get_tiles(scaled)
+        batchTime = time.perf_counter() - start
+        assert np.array_equal(expected, single) and np.array_equal(expected, batch)
+    return {
+        'tiles': 1e6 * referenceTime / states,
+        'single': 1e6 * singleTime / states,
+        'batch': 1e6 * batchTime / states
+    }
+
+if __name__ == '__main__':
+    from tamerAgent import IHT, tiles
+    results = benchmark(IHT, tiles)
+    print(f'tiles(): {results["tiles"]:.2f} us/state')
+    print(f'TileCoder one state: {results["single"]:.2f} us/state ({results["tiles"] / results["single"]:.1f}x)')
+    print(f'TileCoder batch: {results["batch"]:.2f} us/state ({results["tiles"] / results["batch"]:.1f}x)')
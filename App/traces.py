@@ -0,0 +1,96 @@
+'''
+Eligibility traces for the human feedback learners built on the agent
+examples (see coachAgent.py). EligibilityTrace keeps a trace the shape of a
+weight array, e.g. (actions, tiles), and applies to it the two operations
+that are usually dense every step, in O(1):
+    trace.decay()              # trace *= decay, for every entry
+    trace.update_weights(step) # weights += step * trace, for every entry
+Work per column (the last axis, e.g. a tile) is only done when its trace is
+read or set, or its weights are read through sync(), so a learner that only
+touches the active tiles of each step costs O(actions x active tiles):
+    trace.set(tiles, trace.get(tiles) * trace_decay + grad[:, None])
+    preferences = trace.sync(tiles).sum(axis=1)
+
+Decay is kept as a global scale: the trace of an entry is its stored value
+times scale, so decay() only multiplies scale. The weight updates are kept
+as a global sum of step * scale over every update_weights(); each column
+records the sum at which its weights were last brought up to date, so its
+pending update is its stored trace times the difference. Stored values grow
+as 1 / scale, so the difference loses about log10(1 / scale) digits: once
+scale falls below minScale, every entry is brought up to date and scale is
+reset to 1. That is O(entries) once every log(minScale) / log(decay) decays,
+about every 87 decays at the defaults and a decay of 0.9.
+'''
+import numpy as np
+
+class EligibilityTrace():
+    '''
+    An eligibility trace for weights, an array updated in place. Columns
+    index the last axis of weights, as an int array, list or slice.
+    '''
+
+    def __init__(self, weights, decay:float=1.0, minScale:float=1e-4):
+        self.weights = weights
+        self.decayRate = decay
+        self.minScale = minScale
+        self.trace = np.zeros(weights.shape)
+        self.scale = 1.0
+        self.total = 0.0
+        self.synced = np.zeros(weights.shape[-1])
+
+    def get(self, columns=slice(None)):
+        '''
+        Returns the trace at the given columns.
+        '''
+        if self.scale == 1.0:
+            return self.trace[..., columns].copy()
+        return self.trace[..., columns] * self.scale
+
+    def set(self, columns, values):
+        '''
+        Sets the trace at the given columns.
+        '''
+        self.sync(columns)
+        self.trace[..., columns] = values if self.scale == 1.0 else values / self.scale
+
+    def decay(self):
+        '''
+        Multiplies the whole trace by the decay rate.
+        '''
+        self.scale *= self.decayRate
+        if self.scale < self.minScale:
+            self.rescale()
+
+    def update_weights(self, step:float):
+        '''
+        Adds step times the trace to the weights.
+        '''
+        self.total += step * self.scale
+
+    def sync(self, columns=slice(None)):
+        '''
+        Brings the weights at the given columns (by default all) up to date
+        and returns them.
+        '''
+        pending = self.total - self.synced[columns]
+        if pending.any():
+            self.weights[..., columns] += self.trace[..., columns] * pending
+            self.synced[columns] = self.total
+        return self.weights[..., columns]
+
+    def rescale(self):
+        self.sync()
+        self.trace *= self.scale
+        self.scale = 1.0
+        self.total = 0.0
+        self.synced[:] = 0.0
+
+    def reset(self):
+        '''
+        Brings every weight up to date and clears the trace.
+        '''
+        self.sync()
+        self.trace[:] = 0.0
+        self.scale = 1.0
+        self.total = 0.0
+        self.synced[:] = 0.0
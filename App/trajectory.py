@@ -0,0 +1,655 @@
+'''
+Writers for the step log files in Trials/, selected by dataFormat in the
+trial config, and a reader for the columnar format.
+
+pickle (default): every step's entry dictionary is pickled to the file in
+turn. With dataFile 'trial', steps are instead buffered and pickled as lists
+of up to recordBufferSize entries, so a short trial is a single pickled list
+as before. read_pickle_log() reads either back.
+
+With logCompression set (gzip, zstd or lz4, see COMPRESSION), pickle files
+start with PICKLE_MAGIC and hold compressed frames of recordBufferSize
+entries each:
+    FRAME_HEADER: compression tag (b'GZIP', b'ZSTD' or b'LZ4F'),
+                  compressed length (uint32), raw length (uint32)
+    compressed pickled list of entries
+
+columnar: steps are buffered and written in chunks. Each chunk holds fixed
+dtype NumPy columns and the observations of its steps as one contiguous
+block, so a reader can memory-map the file and read a single column without
+unpickling anything. Everything else in the entries (info, participant
+messages) is pickled once per chunk. The frameId column holds the Trial's
+frameId for the step; a frameId sent by the participant is kept with the
+rest of their message.
+
+Columnar file layout:
+    MAGIC
+    chunk, chunk, ...
+Chunk layout:
+    CHUNK_HEADER: b'CHNK', length of the json description (uint32),
+                  length of the body (uint64)
+    json description: {'steps': int, 'columns': [{'name', 'dtype', 'shape',
+                       'offset', 'nbytes'}, ...]}, offsets relative to the body
+    zero padding so the body starts on a multiple of ALIGNMENT in the file
+    body
+With logCompression set the body is compressed, the description records the
+compression and the column offsets are positions in the decompressed body.
+
+With observationStorage 'dedup' each distinct observation is stored once, in
+the chunk where it first appears, identified by a hash of its contents. The
+chunk's observation column then holds only its new observations, numbered
+in order through the file from the description's 'firstObservation', and an
+observationRef column gives each step's observation number. With 'xor' the
+new observations of a chunk are additionally stored XORed with the one
+before, the first of each chunk as is; near-identical observations become
+mostly zero bytes, which logCompression shrinks to almost nothing.
+A file cut short by a crash is readable up to its last complete chunk or
+frame.
+
+Run this file with a log file to compare the write throughput and
+compression ratio of each logCompression setting on its steps:
+    python3 trajectory.py Trials/episode_1_user_x
+'''
+import json, mmap, struct, sys, os, time, gzip, hashlib, logging, tempfile
+import _pickle as cPickle
+import numpy as np
+from collections import OrderedDict
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+MAGIC = b'HGTRAJ1\n'
+CHUNK_HEADER = struct.Struct('<4sIQ')
+ALIGNMENT = 64
+CACHED_CHUNKS = 4
+PICKLE_MAGIC = b'HGPKLZ1\n'
+FRAME_HEADER = struct.Struct('<4sII')
+
+# name, dtype and missing value of the fixed columns
+COLUMNS = [
+    ('timestamp', np.float64, np.nan),
+    ('frameId', np.int64, -1),
+    ('humanAction', np.int64, -1),
+    ('agentAction', np.int64, -1),
+    ('reward', np.float64, np.nan),
+    ('done', np.bool_, False)
+]
+COLUMN_KEYS = ('frameId', 'agentAction', 'reward', 'done', 'observation')
+OBSERVATION_STORAGE = ('full', 'dedup', 'xor')
+
+class Compression():
+    '''
+    A block compression algorithm. level None uses the library default.
+    '''
+
+    def __init__(self, name:str, tag:bytes, compress, decompress, available:bool=True):
+        self.name = name
+        self.tag = tag
+        self.compress = compress
+        self.decompress = decompress
+        self.available = available
+
+def zstd_compress(data, level=None):
+    return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+
+def zstd_decompress(data, size):
+    return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+
+COMPRESSION = {
+    'gzip': Compression('gzip', b'GZIP',
+        lambda data, level=None: gzip.compress(data, 1 if level is None else level),
+        lambda data, size: gzip.decompress(data)),
+    'zstd': Compression('zstd', b'ZSTD', zstd_compress, zstd_decompress, zstandard is not None),
+    'lz4': Compression('lz4', b'LZ4F',
+        lambda data, level=None: lz4.frame.compress(data, 0 if level is None else level),
+        lambda data, size: lz4.frame.decompress(data), lz4 is not None)
+}
+TAGS = {compression.tag: compression for compression in COMPRESSION.values()}
+
+def get_compression(config:dict):
+    '''
+    Returns the Compression selected by logCompression, or None if logs are
+    not compressed. zstd and lz4 need the zstandard and lz4 packages; if
+    they are not installed the log is written uncompressed.
+    '''
+    name = config.get('logCompression')
+    if not name:
+        return None
+    if name not in COMPRESSION:
+        raise ValueError(f'Unknown logCompression {name}, expected one of {list(COMPRESSION)}')
+    if not COMPRESSION[name].available:
+        logging.warning(f'logCompression {name} requires the {"zstandard" if name == "zstd" else name} package, writing uncompressed logs.')
+        return None
+    return COMPRESSION[name]
+
+def get_writer(config:dict, path:str):
+    '''
+    Opens path for appending with the writer selected by dataFormat and
+    logCompression.
+    '''
+    compression = get_compression(config)
+    level = config.get('compressionLevel')
+    storage = config.get('observationStorage') or 'full'
+    if storage not in OBSERVATION_STORAGE:
+        raise ValueError(f'Unknown observationStorage {storage}, expected one of {list(OBSERVATION_STORAGE)}')
+    if config.get('dataFormat', 'pickle') == 'columnar':
+        return ColumnarWriter(open(path, 'ab'), config.get('chunkSize', 256), compression, level, storage)
+    if storage != 'full':
+        logging.warning(f'observationStorage {storage} requires dataFormat columnar, storing full observations.')
+    if compression:
+        return CompressedPickleWriter(open(path, 'ab'), config.get('recordBufferSize', 1000), compression, level)
+    bufferSize = config.get('recordBufferSize', 1000) if config.get('dataFile') == 'trial' else 0
+    return PickleWriter(open(path, 'ab'), bufferSize)
+
+def read_pickle_log(path:str):
+    '''
+    Yields the entries of a pickle format log file in order, whether they
+    were written one per step, as lists, or as compressed frames.
+    '''
+    with open(path, 'rb') as infile:
+        if infile.read(len(PICKLE_MAGIC)) == PICKLE_MAGIC:
+            yield from read_compressed_frames(infile)
+            return
+        infile.seek(0)
+        while True:
+            try:
+                item = cPickle.load(infile)
+            except EOFError:
+                return
+            if isinstance(item, list):
+                yield from item
+            else:
+                yield item
+
+def read_entries(path:str):
+    '''
+    Yields the entries of a log file of either dataFormat. Entries read from
+    a columnar file are rebuilt from its columns and extras.
+    '''
+    with open(path, 'rb') as infile:
+        columnar = infile.read(len(MAGIC)) == MAGIC
+    if not columnar:
+        yield from read_pickle_log(path)
+        return
+    reader = ColumnarReader(path)
+    step = 0
+    for chunk in reader.iter_chunks():
+        for index, extra in enumerate(reader.extras_of(chunk)):
+            entry = dict(extra)
+            for key in ('agentAction', 'reward', 'done'):
+                entry[key] = chunk[key][index].item()
+            entry.setdefault('frameId', chunk['frameId'][index].item()) # the participant's, as in pickle logs
+            if 'observation' in chunk or 'observationRef' in chunk:
+                entry['observation'] = np.array(reader.observation(step))
+            step += 1
+            yield entry
+    chunk = None
+    reader.close()
+
+def read_compressed_frames(infile):
+    while True:
+        header = infile.read(FRAME_HEADER.size)
+        if len(header) < FRAME_HEADER.size:
+            return
+        tag, length, rawLength = FRAME_HEADER.unpack(header)
+        data = infile.read(length)
+        if tag not in TAGS or len(data) < length:
+            return # incomplete frame at the end of a crashed trial's file
+        yield from cPickle.loads(TAGS[tag].decompress(data, rawLength))
+
+class PickleWriter():
+    '''
+    Pickles each entry to the file as it is written, or with bufferSize set,
+    pickles lists of bufferSize entries.
+    '''
+
+    def __init__(self, outfile, bufferSize:int=0):
+        self.outfile = outfile
+        self.bufferSize = bufferSize
+        self.buffer = []
+
+    def write(self, entry:dict, frameId:int=None, humanAction:int=None, timestamp:float=None):
+        if not self.bufferSize:
+            cPickle.dump(entry, self.outfile)
+            return
+        self.buffer.append(entry)
+        if len(self.buffer) >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            cPickle.dump(self.buffer, self.outfile)
+            self.buffer = []
+        self.outfile.flush()
+
+    def close(self):
+        self.flush()
+        self.outfile.close()
+
+class CompressedPickleWriter(PickleWriter):
+    '''
+    Pickles lists of bufferSize entries and writes each list as a
+    compressed frame.
+    '''
+
+    def __init__(self, outfile, bufferSize:int=1000, compression:Compression=None, level:int=None):
+        super().__init__(outfile, max(1, bufferSize))
+        self.compression = compression
+        self.level = level
+        if self.outfile.tell() == 0:
+            self.outfile.write(PICKLE_MAGIC)
+
+    def flush(self):
+        if self.buffer:
+            data = cPickle.dumps(self.buffer, -1)
+            compressed = self.compression.compress(data, self.level)
+            self.outfile.write(FRAME_HEADER.pack(self.compression.tag, len(compressed), len(data)))
+            self.outfile.write(compressed)
+            self.buffer = []
+        self.outfile.flush()
+
+def xor_encode(block):
+    '''
+    XORs each observation in a block with the one before, byte for byte.
+    '''
+    unsigned = block.view(np.dtype(f'u{block.dtype.itemsize}'))
+    encoded = unsigned.copy()
+    np.bitwise_xor(unsigned[1:], unsigned[:-1], out=encoded[1:])
+    return encoded.view(block.dtype)
+
+def xor_decode(block):
+    '''
+    Reverses xor_encode().
+    '''
+    unsigned = block.view(np.dtype(f'u{block.dtype.itemsize}'))
+    return np.bitwise_xor.accumulate(unsigned, axis=0).view(block.dtype)
+
+class ColumnarWriter():
+    '''
+    Buffers entries and writes them as columnar chunks of chunkSize steps,
+    compressing each chunk's body if a Compression is given. With storage
+    'dedup' or 'xor' each distinct observation is written once; the hashes
+    of the observations seen so far are kept in memory, 16 bytes each.
+    Appending to an existing log carries on from its last complete chunk
+    (see resume()).
+    '''
+
+    def __init__(self, outfile, chunkSize:int=256, compression:Compression=None, level:int=None, storage:str='full'):
+        self.outfile = outfile
+        self.chunkSize = chunkSize
+        self.compression = compression
+        self.level = level
+        self.storage = storage
+        self.rows = []
+        self.observations = []
+        self.newObservations = []
+        self.observationIds = {}
+        self.extras = []
+        self.signature = None
+        self.firstObservation = 0 # number of the first observation written by this writer
+        if self.outfile.tell() == 0:
+            self.outfile.write(MAGIC)
+        else:
+            self.resume()
+
+    def resume(self):
+        '''
+        Prepares to append to an existing columnar log: drops an incomplete
+        chunk left at the end by a crash, which would otherwise hide every
+        chunk appended after it from readers, and numbers new observations
+        after the last one in the file. The observations already in the file
+        are not hashed, so the first appended chunk stores its observations
+        afresh, like a keyframe.
+        '''
+        with open(self.outfile.name, 'rb') as infile:
+            if infile.read(len(MAGIC)) != MAGIC:
+                return
+            size = os.fstat(infile.fileno()).st_size
+            position = len(MAGIC)
+            while position + CHUNK_HEADER.size <= size:
+                tag, descriptionLength, bodyLength = CHUNK_HEADER.unpack(infile.read(CHUNK_HEADER.size))
+                end = position + CHUNK_HEADER.size + descriptionLength + bodyLength
+                if tag != b'CHNK' or end > size:
+                    break
+                description = json.loads(infile.read(descriptionLength))
+                for column in description['columns']:
+                    if column['name'] == 'observation' and 'firstObservation' in description:
+                        self.firstObservation = max(self.firstObservation, description['firstObservation'] + column['shape'][0])
+                position = end
+                infile.seek(position)
+        self.outfile.truncate(position)
+
+    def write(self, entry:dict, frameId:int=None, humanAction:int=None, timestamp:float=None):
+        '''
+        Adds a step. frameId and humanAction are the Trial's values for the
+        step; frameId falls back to any frameId in the entry. timestamp
+        defaults to now.
+        '''
+        observation = entry.get('observation')
+        if observation is not None:
+            observation = np.asarray(observation)
+            if observation.dtype == object:
+                observation = None
+        signature = None if observation is None else (observation.shape, observation.dtype)
+        if self.rows and signature != self.signature:
+            self.flush() # a chunk's observations must share a shape and dtype
+        self.signature = signature
+        extra = {key: value for key, value in entry.items() if key not in COLUMN_KEYS}
+        if frameId is not None and 'frameId' in entry:
+            extra['frameId'] = entry['frameId'] # the participant's, the column holds the Trial's
+        if observation is None and 'observation' in entry:
+            extra['observation'] = entry['observation']
+        self.rows.append((
+            time.time() if timestamp is None else timestamp,
+            entry.get('frameId', -1) if frameId is None else frameId,
+            -1 if humanAction is None else humanAction,
+            entry.get('agentAction', -1),
+            entry.get('reward', np.nan),
+            bool(entry.get('done', False))
+        ))
+        if self.storage != 'full' and observation is not None:
+            observation = self.observation_id(observation)
+        self.observations.append(observation)
+        self.extras.append(extra)
+        if len(self.rows) >= self.chunkSize:
+            self.flush()
+
+    def observation_id(self, observation):
+        '''
+        Returns the number of an observation, adding it to the chunk's new
+        observations if it has not been seen before.
+        '''
+        observation = np.ascontiguousarray(observation)
+        key = (observation.shape, observation.dtype.str, hashlib.blake2b(observation.data, digest_size=16).digest())
+        observationId = self.observationIds.get(key)
+        if observationId is None:
+            observationId = self.observationIds[key] = self.firstObservation + len(self.observationIds)
+            self.newObservations.append(observation)
+        return observationId
+
+    def flush(self):
+        '''
+        Writes the buffered steps as one chunk.
+        '''
+        if not self.rows:
+            return
+        arrays = []
+        for i, (name, dtype, missing) in enumerate(COLUMNS):
+            values = [row[i] for row in self.rows]
+            arrays.append((name, np.array([missing if value is None else value for value in values], dtype=dtype)))
+        info = {}
+        if self.observations[0] is None:
+            pass
+        elif self.storage == 'full':
+            arrays.append(('observation', np.stack(self.observations)))
+        else:
+            arrays.append(('observationRef', np.array(self.observations, dtype=np.int64)))
+            if self.newObservations:
+                block = np.stack(self.newObservations)
+                arrays.append(('observation', xor_encode(block) if self.storage == 'xor' else block))
+            info = {'observations': self.storage, 'firstObservation': self.firstObservation + len(self.observationIds) - len(self.newObservations)}
+        arrays.append(('extras', np.frombuffer(cPickle.dumps(self.extras, -1), dtype=np.uint8)))
+        self.write_chunk(arrays, info)
+        self.rows = []
+        self.observations = []
+        self.newObservations = []
+        self.extras = []
+
+    def write_chunk(self, arrays:list, info:dict=None):
+        columns = []
+        offset = 0
+        for name, array in arrays:
+            offset += -offset % ALIGNMENT
+            columns.append({'name': name, 'dtype': array.dtype.str, 'shape': list(array.shape),
+                            'offset': offset, 'nbytes': array.nbytes})
+            offset += array.nbytes
+        description = {'steps': len(self.rows), 'columns': columns}
+        description.update(info or {})
+        if self.compression:
+            body = bytearray(offset)
+            for column, (name, array) in zip(columns, arrays):
+                body[column['offset']:column['offset'] + column['nbytes']] = np.ascontiguousarray(array).tobytes()
+            body = self.compression.compress(bytes(body), self.level)
+            description['compression'] = self.compression.name
+            description['rawBytes'] = offset
+            self.write_description(description, len(body))
+            self.outfile.write(body)
+        else:
+            self.write_description(description, offset)
+            position = 0
+            for column, (name, array) in zip(columns, arrays):
+                self.outfile.write(b'\0' * (column['offset'] - position))
+                self.outfile.write(np.ascontiguousarray(array).data)
+                position = column['offset'] + column['nbytes']
+        self.outfile.flush()
+
+    def write_description(self, description:dict, bodyLength:int):
+        description = json.dumps(description).encode('utf-8')
+        start = self.outfile.tell() + CHUNK_HEADER.size + len(description)
+        padding = -start % ALIGNMENT
+        self.outfile.write(CHUNK_HEADER.pack(b'CHNK', len(description) + padding, bodyLength))
+        self.outfile.write(description + b' ' * padding)
+
+    def close(self):
+        self.flush()
+        self.outfile.close()
+
+class ColumnarReader():
+    '''
+    Memory-maps a columnar step log. Columns are read without copying when
+    the file has a single uncompressed chunk, observations are only read
+    from disk when they are accessed. Compressed chunks and xor stored
+    observations are decoded when first accessed, keeping the most recent
+    CACHED_CHUNKS chunks in memory. De-duplicated observations are looked
+    up through the observationRef column, so steps read back exactly as
+    they were logged.
+        reader = ColumnarReader('Trials/episode_1_user_x')
+        reader.column('reward')      # npArray of every step's reward
+        reader.observation(10)       # the observation of step 10
+        reader.extras()              # list of the remaining entry values
+    '''
+
+    def __init__(self, path:str):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f'{path} is not a columnar step log')
+        self.chunks = []
+        self.lazy = {}
+        self.cache = OrderedDict()
+        self.starts = []
+        self.steps = 0
+        self.observationStarts = []
+        self.observationChunks = []
+        position = len(MAGIC)
+        while position + CHUNK_HEADER.size <= len(self.map):
+            tag, descriptionLength, bodyLength = CHUNK_HEADER.unpack_from(self.map, position)
+            body = position + CHUNK_HEADER.size + descriptionLength
+            if tag != b'CHNK' or body + bodyLength > len(self.map):
+                break # incomplete chunk at the end of a crashed trial's file
+            description = json.loads(self.map[position + CHUNK_HEADER.size:body])
+            if 'firstObservation' in description and any(column['name'] == 'observation' for column in description['columns']):
+                self.observationStarts.append(description['firstObservation'])
+                self.observationChunks.append(len(self.chunks))
+            if description.get('compression') or description.get('observations') == 'xor':
+                self.lazy[len(self.chunks)] = (description, body, bodyLength)
+                self.chunks.append(None)
+            else:
+                self.chunks.append(self.column_views(description, self.map, body))
+            self.starts.append(self.steps)
+            self.steps += description['steps']
+            position = body + bodyLength
+
+    def __len__(self):
+        return self.steps
+
+    def column_views(self, description:dict, buffer, body:int):
+        chunk = {}
+        for column in description['columns']:
+            chunk[column['name']] = np.frombuffer(buffer, dtype=np.dtype(column['dtype']),
+                count=int(np.prod(column['shape'], dtype=np.int64)),
+                offset=body + column['offset']).reshape(column['shape'])
+        return chunk
+
+    def chunk(self, index:int):
+        '''
+        Returns the arrays of a chunk, decompressing and decoding it if
+        necessary.
+        '''
+        if self.chunks[index] is not None:
+            return self.chunks[index]
+        if index in self.cache:
+            self.cache.move_to_end(index)
+            return self.cache[index]
+        description, body, bodyLength = self.lazy[index]
+        if description.get('compression'):
+            data = COMPRESSION[description['compression']].decompress(self.map[body:body + bodyLength], description['rawBytes'])
+            chunk = self.column_views(description, data, 0)
+        else:
+            chunk = self.column_views(description, self.map, body)
+        if description.get('observations') == 'xor' and 'observation' in chunk:
+            chunk['observation'] = xor_decode(chunk['observation'])
+        self.cache[index] = chunk
+        if len(self.cache) > CACHED_CHUNKS:
+            self.cache.popitem(last=False)
+        return chunk
+
+    def iter_chunks(self):
+        for index in range(len(self.chunks)):
+            yield self.chunk(index)
+
+    def column(self, name:str):
+        '''
+        Returns one of the fixed columns (see COLUMNS) for every step.
+        '''
+        arrays = [chunk[name] for chunk in self.iter_chunks()]
+        if len(arrays) == 1:
+            return arrays[0]
+        if not arrays:
+            dtype = dict((column[0], column[1]) for column in COLUMNS)[name]
+            return np.zeros(0, dtype=dtype)
+        return np.concatenate(arrays)
+
+    def locate(self, step:int):
+        '''
+        Returns (chunk, index within chunk) for a step number.
+        '''
+        if step < 0:
+            step += self.steps
+        if not 0 <= step < self.steps:
+            raise IndexError(step)
+        chunk = int(np.searchsorted(self.starts, step, side='right')) - 1
+        return self.chunk(chunk), step - self.starts[chunk]
+
+    def observation(self, step:int):
+        '''
+        Returns the observation of a step as a read-only npArray, memory-mapped
+        if the file is not compressed. Copy it to keep it after close() without
+        keeping the map.
+        '''
+        chunk, index = self.locate(step)
+        if 'observationRef' in chunk:
+            return self.stored_observation(int(chunk['observationRef'][index]))
+        if 'observation' in chunk:
+            return chunk['observation'][index]
+        return self.extras_of(chunk)[index].get('observation')
+
+    def stored_observation(self, observationId:int):
+        '''
+        Returns a de-duplicated observation by its number.
+        '''
+        position = int(np.searchsorted(self.observationStarts, observationId, side='right')) - 1
+        if position < 0:
+            raise IndexError(observationId)
+        chunk = self.chunk(self.observationChunks[position])
+        return chunk['observation'][observationId - self.observationStarts[position]]
+
+    def iter_observations(self):
+        '''
+        Yields the observations of every step in order, one chunk in memory
+        at a time.
+        '''
+        for chunk in self.iter_chunks():
+            if 'observationRef' in chunk:
+                for observationId in chunk['observationRef']:
+                    yield self.stored_observation(int(observationId))
+            elif 'observation' in chunk:
+                yield from chunk['observation']
+            else:
+                for extra in self.extras_of(chunk):
+                    yield extra.get('observation')
+
+    def extras_of(self, chunk:dict):
+        return cPickle.loads(chunk['extras'].tobytes())
+
+    def extras(self):
+        '''
+        Returns the values of each step's entry that are not stored as
+        columns, as a list of dictionaries.
+        '''
+        extras = []
+        for chunk in self.iter_chunks():
+            extras.extend(self.extras_of(chunk))
+        return extras
+
+    def close(self):
+        '''
+        Closes the file. Arrays from column() and observation() of an
+        uncompressed file are views of its memory map, which stays open
+        while any of them is referenced and closes once they are freed.
+        '''
+        self.chunks = []
+        self.lazy = {}
+        self.cache.clear()
+        try:
+            self.map.close()
+        except BufferError:
+            pass # views still exported, the map is released with them
+        self.file.close()
+
+def benchmark(entries:list, dataFormat:str='pickle', chunkSize:int=256, bufferSize:int=1000):
+    '''
+    Writes the entries with every available logCompression, and none, in a
+    temporary directory. Returns a list of dictionaries with the write and
+    read throughput (MB/s of uncompressed log) and the compression ratio.
+    '''
+    results = []
+    for name in [None] + [name for name, compression in COMPRESSION.items() if compression.available]:
+        config = {'dataFormat': dataFormat, 'dataFile': 'trial', 'logCompression': name,
+                  'chunkSize': chunkSize, 'recordBufferSize': bufferSize}
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'log')
+            start = time.perf_counter()
+            writer = get_writer(config, path)
+            for entry in entries:
+                writer.write(entry)
+            writer.close()
+            writeTime = time.perf_counter() - start
+            size = os.path.getsize(path)
+            start = time.perf_counter()
+            steps = sum(1 for entry in read_entries(path))
+            readTime = time.perf_counter() - start
+        if name is None:
+            rawSize = size
+        results.append({
+            'compression': name or 'none',
+            'steps': steps,
+            'bytes': size,
+            'ratio': rawSize / size,
+            'writeMBps': rawSize / writeTime / 1e6,
+            'readMBps': rawSize / readTime / 1e6
+        })
+    return results
+
+if __name__ == '__main__':
+    entries = list(read_entries(sys.argv[1]))
+    print(f'{len(entries)} steps from {sys.argv[1]}')
+    print(f'{"format":8} {"compression":11} {"bytes":>12} {"ratio":>6} {"write MB/s":>10} {"read MB/s":>10}')
+    for dataFormat in ('pickle', 'columnar'):
+        for row in benchmark(entries, dataFormat):
+            print(f'{dataFormat:8} {row["compression"]:11} {row["bytes"]:>12} {row["ratio"]:>6.2f} {row["writeMBps"]:>10.1f} {row["readMBps"]:>10.1f}')
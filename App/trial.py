@@ -1,8 +1,16 @@
-import numpy, json, shortuuid, time, base64, yaml, logging
-import _pickle as cPickle
-from PIL import Image
-from io import BytesIO
+import numpy, json, shortuuid, time, base64, yaml, logging, struct
+from concurrent.futures import ThreadPoolExecutor
 from agent import Agent # this is the Agent/Environment compo provided by the researcher
+from scheduler import FrameScheduler
+from framering import FrameRing
+from framecodec import get_codec, JPEG_FRAME
+from bitrate import BitrateController
+from logwriter import LogWriter
+
+# Header prepended to every frame in binary frameTransport mode:
+# frame type (uint8), frameId (uint32), server timestamp in seconds (float64), network byte order
+FRAME_HEADER = struct.Struct('!BId')
+DISCONNECTED = (EOFError, BrokenPipeError, ConnectionResetError) # the communicator closed the trial's Pipe
 
 def load_config():
     logging.info('Loading Config in trial.py')
@@ -13,26 +21,41 @@ def load_config():
 
 class Trial():
     
-    def __init__(self, pipe):
+    def __init__(self, pipe, ringName:str=None, warmUp:bool=False, autoRun:bool=True):
         self.config = load_config()
         self.pipe = pipe
+        self.ring = FrameRing.attach(ringName) if ringName else None
         self.frameId = 0
         self.humanAction = 0
         self.episode = 0
         self.done = False
         self.play = False
-        self.record = []
         self.nextEntry = {}
         self.trialId = shortuuid.uuid()
-        self.outfile = None
+        self.logWriter = LogWriter(self.config, self.config.get('logQueueSize', 1024))
         self.framerate = self.config.get('startingFrameRate', 30)
+        self.scheduler = FrameScheduler(self.framerate, self.config.get('maxFrameSkip', 2))
         self.userId = None
         self.projectId = self.config.get('projectId')
         self.filename = None
         self.path = None
+        self.archive = None
+        self.archived = 0
+        self.binaryFrames = self.config.get('frameTransport', 'json') == 'binary'
+        self.codec = get_codec(self.config)
+        self.encoder = None
+        self.pendingRender = None
+        if self.config.get('pipelinedEncoding'):
+            self.encoder = ThreadPoolExecutor(max_workers=1)
+        self.bitrate = None
+        if self.config.get('adaptiveBitrate'):
+            self.bitrate = BitrateController(self.trialId, self.config.get('targetLatency', 0.25), self.config.get('maxSendQueue', 4))
 
         self.start()
-        self.run()
+        if warmUp:
+            self.warm_up()
+        if autoRun:
+            self.run()
 
     def start(self):
         '''
@@ -45,38 +68,86 @@ class Trial():
         self.agent = Agent()
         self.agent.start(self.config.get('game'))
 
+    def warm_up(self):
+        '''
+        Resets and renders the environment once so that lazy initialisation
+        (ROM loading, renderer setup) happens before a participant connects.
+        Used for trials started ahead of time by the trial pool.
+        '''
+        self.agent.reset()
+        self.agent.render()
+
     def run(self):
         '''
         This is the main event controlling function for a Trial. 
-        It handles the render-step loop
-        '''
-        while not self.done:
-            message = self.check_message()
-            if message:
-                self.handle_message(message)
-            if self.play:
-                render = self.get_render()
-                self.send_render(render)
-                self.take_step()
-            time.sleep(1/self.framerate)
+        It handles the render-step loop, paced by self.scheduler so that
+        each iteration starts on its frame deadline regardless of how long
+        the render and step took. Renders are skipped while behind schedule.
+        The communicator stops the trial when its participant disconnects,
+        but if it closes the Pipe first the trial is closed without it, so
+        the steps logged so far are kept.
+        '''
+        try:
+            while not self.done:
+                self.tick()
+                self.scheduler.wait()
+        except DISCONNECTED:
+            logging.info(f'Trial {self.trialId} disconnected')
+            self.close()
+
+    def tick(self):
+        '''
+        One iteration of the render-step loop: handles a waiting message, then
+        renders, sends and steps if playing, then sends upload requests for
+        log files the log writer thread has finished.
+        With pipelinedEncoding the frame is encoded on a worker thread while
+        the agent steps, and sent once both are finished.
+        Trials created with autoRun=False are driven by calling tick() on 
+        their frame deadlines (see multitrial.py), or, with batchSteps, by 
+        calling start_tick(), send_frame(), record_step() and finish_tick() 
+        for several trials at once.
+        '''
+        if self.start_tick():
+            if self.scheduler.should_render():
+                self.send_frame(self.agent.render())
+            self.take_step()
+        self.finish_tick()
+
+    def start_tick(self):
+        '''
+        Handles a waiting message. Returns True if the trial is playing, that
+        is if it should render and step this tick.
+        '''
+        message = self.check_message()
+        if message:
+            self.handle_message(message)
+        return self.play
+
+    def finish_tick(self):
+        '''
+        Sends the frame still being encoded, if any, and upload requests.
+        '''
+        self.send_pending_render()
+        self.send_uploads()
 
     def reset(self):
         '''
         Resets the OpenAI gym environment to start a new episode.
-        By default this function will create a new log file for every
-        episode, if the intention is to log only full trials then
-        comment the 3 lines below contianing self.outfile and 
-        self.create_file.
+        With dataFile 'episode' this function will create a new log file for 
+        every episode and upload the previous one. With dataFile 'trial' the
+        log file is created for the first episode and kept open until end().
         '''
         if self.check_trial_done():
             self.end()
         else:
             self.agent.reset()
-            if self.outfile:
-                self.outfile.close()
-                if self.config.get('s3upload'):
-                    self.pipe.send({'upload':{'projectId':self.projectId ,'userId':self.userId,'file':self.filename,'path':self.path, 'bucket': self.config.get('bucket')}})
-            self.create_file()
+            if self.config.get('dataFile') == 'trial':
+                if not self.path:
+                    self.create_file()
+            else:
+                if self.path:
+                    self.logWriter.close_file((self.filename, self.path))
+                self.create_file()
             self.episode += 1
 
     def check_trial_done(self):
@@ -88,21 +159,75 @@ class Trial():
 
     def end(self):
         '''
-        Closes the environment through the agent, closes any remaining outfile
-        and sends the 'done' message to the websocket pipe. If logging the 
-        whole trial memory in self.record, uncomment the call to self.save_record()
-        to write the record to file before closing.
-        '''
+        Closes the environment through the agent, closes any remaining log file
+        and sends the 'done' message to the websocket pipe. With dataFile
+        'trial' the trial log file is finalized here: it is written under a
+        '.partial' name during the trial and renamed once complete.
+        Waits for the log writer thread to finish writing before asking for
+        the last upload, and sends 'done' last, so the communicator has every
+        upload request before the participant is told the trial is over and
+        closes the connection.
+        '''
+        self.send_pending_render()
+        self.close()
+        self.send_uploads()
+        if self.archived:
+            self.pipe.send({'upload':{'projectId':self.projectId, 'userId':self.userId, 'archive':self.archive, 'finish':True, 'bucket':self.config.get('bucket')}})
+            self.archived = 0
         self.pipe.send('done')
-        self.agent.close()
-        if self.config.get('dataFile') == 'trial':
-            self.save_record()
-        if self.outfile:
-            self.outfile.close()
-            self.pipe.send({'upload':{'projectId':self.projectId,'userId':self.userId,'file':self.filename,'path':self.path}})
+
+    def close(self):
+        '''
+        Stops the trial without talking to the websocket pipe: closes the
+        encoder, frame ring, environment and log file, keeping every step
+        logged so far. Called by end(), and directly for a trial whose pipe
+        has been closed.
+        '''
+        if self.done:
+            return
+        if self.encoder:
+            self.encoder.shutdown()
+            self.encoder = None
+        logging.info(f'Trial {self.trialId} frame timing: {self.scheduler.stats()}')
+        if self.ring:
+            logging.info(f'Trial {self.trialId} frames refused by full ring: {self.ring.overflows}')
+            self.ring.close()
+            self.ring = None
+        try:
+            self.agent.close()
+        except Exception:
+            logging.exception(f'Trial {self.trialId} failed to close its agent')
+        if self.path:
+            self.logWriter.close_file((self.filename, self.path))
+            self.path = None
+        self.close_log()
         self.play = False
         self.done = True
 
+    def close_log(self):
+        '''
+        Stops the log writer thread once everything queued has been written.
+        '''
+        self.logWriter.close()
+        logging.info(f'Trial {self.trialId} log writer: {self.logWriter.stats()}')
+
+    def send_uploads(self):
+        '''
+        Asks the communicator to upload each log file the log writer thread
+        has finished, if s3upload is set. With archiveEpisodes and dataFile
+        'episode' the files are appended to the trial's archive instead (see
+        archive.py), which end() asks the communicator to complete.
+        '''
+        while self.logWriter.completed:
+            filename, path = self.logWriter.completed.popleft()
+            if self.config.get('s3upload'):
+                upload = {'projectId':self.projectId ,'userId':self.userId,'file':filename,'path':path, 'bucket': self.config.get('bucket')}
+                if self.config.get('archiveEpisodes') and self.config.get('dataFile') != 'trial':
+                    self.archive = f'episodes_user_{self.userId}'
+                    upload['archive'] = self.archive
+                    self.archived += 1
+                self.pipe.send({'upload':upload})
+
     def check_message(self):
         '''
         Checks pipe for messages from websocket, tries to parse message from
@@ -123,12 +248,17 @@ class Trial():
         Reads messages sent from websocket, handles commands as priority then 
         actions. Logs entire message in self.nextEntry
         '''
+        message = self.handle_feedback(message)
+        if not message:
+            return
         if not self.userId and 'userId' in message:
             self.userId = message['userId'] or f'user_{shortuuid.uuid()}'
             self.send_ui()
             self.reset()
             render = self.get_render()
             self.send_render(render)
+        if message.get('requestKeyframe'):
+            self.codec.reset()
         if 'command' in message and message['command']:
             self.handle_command(message['command'])
         elif 'changeFrameRate' in message and message['changeFrameRate']:
@@ -177,6 +307,42 @@ class Trial():
                     self.framerate = requested
             except:
                 pass
+        self.apply_frame_settings()
+
+    def handle_feedback(self, message:dict):
+        '''
+        Passes connection feedback, frame acknowledgements from the client
+        and send queue depth from the communicator, to the bitrate controller.
+        Feedback is not participant input so it is removed from the message
+        before the message is logged.
+        '''
+        if 'ack' not in message and 'sendQueue' not in message:
+            return message
+        message = dict(message)
+        ack = message.pop('ack', None)
+        sendQueue = message.pop('sendQueue', None)
+        if self.bitrate:
+            changed = False
+            if ack is not None:
+                changed = self.bitrate.ack(ack)
+            if sendQueue is not None:
+                changed = self.bitrate.queue(sendQueue) or changed
+            if changed:
+                self.apply_frame_settings()
+        return message
+
+    def apply_frame_settings(self):
+        '''
+        Applies the current frame rate, adjusted along with the encode
+        quality and scale by the bitrate controller if adaptiveBitrate is set.
+        '''
+        framerate = self.framerate
+        if self.bitrate:
+            settings = self.bitrate.settings()
+            self.codec.quality = max(1, round(self.config.get('frameQuality', 75) * settings['quality']))
+            self.codec.scale = self.config.get('frameScale', 1) * settings['scale']
+            framerate *= settings['framerate']
+        self.scheduler.set_framerate(framerate)
 
 
     def handle_action(self, action:str):
@@ -200,30 +366,104 @@ class Trial():
     def get_render(self):
         '''
         Calls the Agent/Environment render function which must return a npArray.
-        Translates the npArray into a jpeg image and then base64 encodes the 
-        image for transmission in json message.
+        Translates the npArray into an image with the codec selected by 
+        frameEncoding (see framecodec.py), jpeg by default. In json 
+        frameTransport mode the image is then base64 encoded for transmission 
+        in json message, in binary mode the raw bytes are kept.
         '''
         render = self.agent.render()
+        self.frameId += 1
+        return self.encode_render(render, self.frameId)
+
+    def send_frame(self, render):
+        '''
+        Encodes and sends a render taken from the agent. With
+        pipelinedEncoding the frameId is taken on this thread, so frames stay
+        aligned with the steps they were rendered before, and the encoding is
+        handed to the single worker thread (PIL releases the GIL while 
+        encoding). The frame is then sent by send_pending_render() after the
+        step.
+        '''
+        self.frameId += 1
+        if self.encoder:
+            render = numpy.array(render) # copy, the env may reuse its buffer
+            self.pendingRender = self.encoder.submit(self.encode_render, render, self.frameId)
+        else:
+            self.send_render(self.encode_render(render, self.frameId))
+
+    def send_pending_render(self):
+        '''
+        Waits for the frame submitted by send_frame() and sends it.
+        '''
+        if self.pendingRender:
+            render = self.pendingRender.result()
+            self.pendingRender = None
+            self.send_render(render)
+
+    def encode_render(self, render, frameId:int):
+        '''
+        Encodes a render npArray into the frame message for frameId.
+        '''
         try:
-            img = Image.fromarray(render)
-            fp = BytesIO()
-            img.save(fp,'JPEG')
-            frame = base64.b64encode(fp.getvalue()).decode('utf-8')
-            fp.close()
+            frameType, frame = self.codec.encode(render)
         except: 
             raise TypeError("Render failed. Is env.render('rgb_array') being called\
                             With the correct arguement?")
-        self.frameId += 1
-        return {'frame': frame, 'frameId': self.frameId}
+        if not self.binaryFrames:
+            frame = base64.b64encode(frame).decode('utf-8')
+        render = {'frame': frame, 'frameId': frameId}
+        if frameType != JPEG_FRAME:
+            render['frameType'] = frameType
+        return render
 
     def send_render(self, render:dict):
         '''
-        Attempts to send render message to websocket
-        '''
-        try: 
-            self.pipe.send(json.dumps(render))
-        except:
-            raise TypeError("Render Dictionary is not JSON serializable")
+        Attempts to send render message to websocket. In binary frameTransport
+        mode the frame is sent as a single bytes message: FRAME_HEADER followed
+        by the jpeg image.
+        If a shared memory frame ring is attached, the frame is written to the
+        ring and only its slot number is sent through the pipe. If the ring is
+        full the frame is dropped, and the bitrate controller told so rather
+        than that it was sent.
+        '''
+        if self.binaryFrames:
+            header = FRAME_HEADER.pack(render.get('frameType', JPEG_FRAME), render['frameId'], time.time())
+            sent = self.send_to_ring(header, render['frame'], binary=True)
+            if sent is None:
+                self.pipe.send(header + render['frame'])
+        else:
+            try: 
+                message = json.dumps(render)
+            except:
+                raise TypeError("Render Dictionary is not JSON serializable")
+            sent = self.send_to_ring(message.encode('utf-8'), binary=False)
+            if sent is None:
+                self.pipe.send(message)
+        if self.bitrate:
+            if sent is False:
+                if self.bitrate.dropped():
+                    self.apply_frame_settings()
+            else:
+                self.bitrate.sent(render['frameId'])
+
+    def send_to_ring(self, *chunks, binary:bool):
+        '''
+        Writes a frame into the shared memory ring and notifies the 
+        communicator. Returns True if the frame was written, False if the ring
+        was full and the frame dropped, and None if there is no ring or the 
+        frame is too large for a slot, in which case the caller sends it 
+        through the pipe.
+        '''
+        if not self.ring:
+            return None
+        if sum(len(chunk) for chunk in chunks) > self.ring.slotSize:
+            return None
+        seq = self.ring.write(*chunks, binary=binary)
+        if seq is None:
+            self.codec.reset() # the client missed a frame, delta codecs resynchronise with a keyframe
+            return False
+        self.pipe.send({'frameSlot': seq})
+        return True
 
     def send_ui(self):
         defaultUI = ['left','right','up','down','start','pause']
@@ -238,7 +478,13 @@ class Trial():
         Records return and saves all memory associated with this setp.
         Checks for DONE from Agent/Env
         '''
-        envState = self.agent.step(self.humanAction)
+        self.record_step(self.agent.step(self.humanAction))
+
+    def record_step(self, envState:dict):
+        '''
+        Records the envState returned by a step and resets the environment
+        if the episode is done.
+        '''
         self.update_entry(envState)
         self.save_entry()
         if envState['done']:
@@ -246,41 +492,33 @@ class Trial():
 
     def save_entry(self):
         '''
-        Either saves step memory to self.record list or pickles the memory and
-        writes it to file, or both.
+        Queues the step memory for the log writer thread, which writes it to
+        file with the writer selected by dataFormat (see trajectory.py and 
+        logwriter.py).
         Note that observation and render objects can get large, an episode can
-        have several thousand steps, holding all the steps for an episode in 
-        memory can cause performance issues if the os needs to grow the heap.
-        The program can also crash if the Server runs out of memory. 
-        It is recommended to write each step to file and not maintain it in
-        memory if the full observation is being saved.
-        comment/uncomment the below lines as desired.
+        have several thousand steps. Writers hold at most chunkSize (columnar)
+        or recordBufferSize (pickle, dataFile 'trial') steps in memory before
+        writing them out, so memory use does not grow with the length of the
+        episode or trial.
         '''
-        if self.config.get('dataFile') == 'trial':
-            self.record.append(self.nextEntry)
-        else:
-            cPickle.dump(self.nextEntry, self.outfile)
-            self.nextEntry = {}
-
-    def save_record(self):
-        '''
-        Saves the self.record object to file. Is only called if uncommented in
-        self.end(). To record full trial records a line must also be uncommented
-        in self.save_entry() and self.create_file()
-        '''
-        cPickle.dump(self.record, self.outfile)
-        self.record = []
+        self.logWriter.write(self.nextEntry, self.frameId, self.humanAction)
+        self.nextEntry = {}
 
     def create_file(self):
         '''
-        Creates a file to record records to. comment/uncomment as desired 
-        for episode or full-trial logging.
+        Creates a file to record records to, one per episode or one for the
+        full trial depending on dataFile. The trial file is written under a 
+        '.partial' name until end(), continuing the file of an earlier
+        session with the same userId. The file is opened by the log writer 
+        thread.
         '''
         if self.config.get('dataFile') == 'trial':
             filename = f'trial_{self.userId}'
+            path = 'Trials/'+filename
+            self.logWriter.open(path + '.partial', path)
         else:
             filename = f'episode_{self.episode}_user_{self.userId}'
-        path = 'Trials/'+filename
-        self.outfile = open(path, 'ab')
+            path = 'Trials/'+filename
+            self.logWriter.open(path)
         self.filename = filename
         self.path = path
@@ -0,0 +1,257 @@
+'''
+Tests for the UploadService jobs (App/s3upload.py) and trial archives
+(App/archive.py) against a moto mock of s3, so no credentials are needed:
+    pip install pytest moto
+    python -m pytest tests
+'''
+import json, os, sys, time
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'App'))
+moto = pytest.importorskip('moto')
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+import archive, s3upload
+
+mock_s3 = getattr(moto, 'mock_aws', None) or getattr(moto, 'mock_s3')
+BUCKET = 'hippo-test'
+sleep = time.sleep # the queueDir fixture turns time.sleep off for retries
+
+@pytest.fixture
+def client(monkeypatch):
+    for name, value in [('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                        ('AWS_DEFAULT_REGION', 'us-east-1')]:
+        monkeypatch.setenv(name, value)
+    with mock_s3():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+@pytest.fixture
+def queueDir(tmp_path, monkeypatch):
+    '''
+    A job queue in a fresh Trials directory, the working directory of the
+    upload process, with retries not waiting.
+    '''
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('Trials/.uploads')
+    monkeypatch.setattr(s3upload.time, 'sleep', lambda delay: None)
+    return os.path.join('Trials', '.uploads')
+
+def write_file(path:str, size:int, seed:int=0):
+    data = os.urandom(size) if seed is None else bytes((seed + i) % 251 for i in range(size))
+    with open(path, 'wb') as outfile:
+        outfile.write(data)
+    return data
+
+def write_job(queueDir:str, job:dict, name:str='job.json'):
+    jobPath = os.path.join(queueDir, name)
+    with open(jobPath, 'w') as outfile:
+        json.dump(job, outfile)
+    return jobPath
+
+def body(client, key:str):
+    return client.get_object(Bucket=BUCKET, Key=key)['Body'].read()
+
+def test_upload_file(client, queueDir):
+    data = write_file('Trials/episode_0_user_a', 1000)
+    job = {'type': 'file', 'path': 'Trials/episode_0_user_a', 'bucket': BUCKET, 'key': 'p/Trials/a/episode_0_user_a'}
+    jobPath = write_job(queueDir, job)
+    s3upload.run_job(jobPath, job, 3, s3upload.upload_file, client, TransferConfig())
+    assert body(client, job['key']) == data
+    assert not os.path.exists(jobPath)
+
+def test_upload_file_multipart(client, queueDir):
+    data = write_file('Trials/trial_user_a', 6 * 1024 * 1024, seed=None)
+    job = {'type': 'file', 'path': 'Trials/trial_user_a', 'bucket': BUCKET, 'key': 'p/Trials/a/trial_user_a'}
+    jobPath = write_job(queueDir, job)
+    transferConfig = TransferConfig(multipart_threshold=5 * 1024 * 1024, multipart_chunksize=5 * 1024 * 1024)
+    s3upload.run_job(jobPath, job, 3, s3upload.upload_file, client, transferConfig)
+    assert body(client, job['key']) == data
+    assert not os.path.exists(jobPath)
+
+def test_retries_until_success(client, queueDir):
+    job = {'type': 'file', 'path': 'Trials/x', 'bucket': BUCKET, 'key': 'p/Trials/a/x'}
+    jobPath = write_job(queueDir, job)
+    calls = []
+    def flaky(job):
+        calls.append(job)
+        if len(calls) < 3:
+            raise ClientError({'Error': {'Code': 'SlowDown', 'Message': 'slow down'}}, 'PutObject')
+    s3upload.run_job(jobPath, job, 5, flaky)
+    assert len(calls) == 3
+    assert not os.path.exists(jobPath)
+
+def test_gives_up_after_retries(client, queueDir):
+    job = {'type': 'file', 'path': 'Trials/x', 'bucket': BUCKET, 'key': 'p/Trials/a/x'}
+    jobPath = write_job(queueDir, job)
+    calls = []
+    def failing(job):
+        calls.append(job)
+        raise ClientError({'Error': {'Code': 'InternalError', 'Message': 'error'}}, 'PutObject')
+    s3upload.run_job(jobPath, job, 2, failing)
+    assert len(calls) == 3
+    assert not os.path.exists(jobPath)
+    assert os.path.exists(jobPath[:-len('.json')] + '.failed')
+
+def test_missing_file_drops_job(client, queueDir):
+    job = {'type': 'file', 'path': 'Trials/missing', 'bucket': BUCKET, 'key': 'p/Trials/a/missing'}
+    jobPath = write_job(queueDir, job)
+    s3upload.run_job(jobPath, job, 3, s3upload.upload_file, client, TransferConfig())
+    assert not os.path.exists(jobPath)
+
+def test_missing_file_drops_archive_job(client, queueDir):
+    job = {'type': 'finish', 'archive': 'episodes_user_a', 'bucket': BUCKET, 'key': 'p/Trials/a/episodes_user_a'}
+    jobPath = write_job(queueDir, job)
+    def missing(job):
+        raise FileNotFoundError(job['archive'])
+    s3upload.run_job(jobPath, job, 3, missing)
+    assert not os.path.exists(jobPath)
+
+def run_archive_job(client, queueDir:str, archives:dict, job:dict, name:str):
+    jobPath = write_job(queueDir, job, name)
+    s3upload.run_job(jobPath, job, 3, s3upload.archive_job, client, archives, archive.MIN_PART_SIZE)
+    assert not os.path.exists(jobPath)
+
+def test_archive_multipart(client, queueDir):
+    key = 'p/Trials/a/episodes_user_a'
+    episodes = {f'episode_{i}_user_a': write_file(f'Trials/episode_{i}_user_a', size, seed=i)
+                for i, size in enumerate([3 * 1024 * 1024, 4 * 1024 * 1024, 100])}
+    archives = {}
+    for i, name in enumerate(episodes):
+        run_archive_job(client, queueDir, archives, {'type': 'append', 'archive': 'episodes_user_a', 'file': name,
+            'path': f'Trials/{name}', 'bucket': BUCKET, 'key': key}, f'{i}.json')
+    state = archives['Trials/episodes_user_a'].state
+    assert len(state['parts']) == 1 # the first 5MB went up before the trial ended
+    run_archive_job(client, queueDir, archives, {'type': 'finish', 'archive': 'episodes_user_a', 'bucket': BUCKET, 'key': key}, '3.json')
+    assert [entry['name'] for entry in archive.list_episodes(client, BUCKET, key)] == list(episodes)
+    for name, data in episodes.items():
+        assert archive.fetch_episode(client, BUCKET, key, name) == data
+    assert not os.path.exists('Trials/episodes_user_a')
+    assert not os.path.exists('Trials/episodes_user_a.state')
+
+def test_archive_resumes_after_restart(client, queueDir):
+    key = 'p/Trials/a/episodes_user_a'
+    first = write_file('Trials/episode_0_user_a', 6 * 1024 * 1024, seed=1)
+    second = write_file('Trials/episode_1_user_a', 1000, seed=2)
+    before = archive.TrialArchive(client, BUCKET, key, 'Trials/episodes_user_a', archive.MIN_PART_SIZE)
+    before.append('episode_0_user_a', 'Trials/episode_0_user_a')
+    with open('Trials/episodes_user_a', 'ab') as outfile:
+        outfile.write(b'torn append') # the process is killed part way through the next append
+    after = archive.TrialArchive(client, BUCKET, key, 'Trials/episodes_user_a', archive.MIN_PART_SIZE)
+    assert after.state['uploadId'] == before.state['uploadId']
+    after.append('episode_1_user_a', 'Trials/episode_1_user_a')
+    after.finish()
+    assert archive.fetch_episode(client, BUCKET, key, 'episode_0_user_a') == first
+    assert archive.fetch_episode(client, BUCKET, key, 'episode_1_user_a') == second
+
+def test_archive_finish_is_idempotent(client, queueDir):
+    key = 'p/Trials/a/episodes_user_a'
+    data = write_file('Trials/episode_0_user_a', 1000)
+    archives = {}
+    append = {'type': 'append', 'archive': 'episodes_user_a', 'file': 'episode_0_user_a',
+              'path': 'Trials/episode_0_user_a', 'bucket': BUCKET, 'key': key, 'id': 'append'}
+    finish = {'type': 'finish', 'archive': 'episodes_user_a', 'bucket': BUCKET, 'key': key, 'id': 'finish'}
+    s3upload.archive_job(append, client, archives, archive.MIN_PART_SIZE)
+    s3upload.archive_job(finish, client, archives, archive.MIN_PART_SIZE) # killed before the job file is removed
+    assert os.path.exists('Trials/episodes_user_a.state')
+    with open('Trials/episodes_user_a.state') as infile:
+        state = json.load(infile)
+    state['completed'] = False # and before the completion was recorded
+    with open('Trials/episodes_user_a.state', 'w') as outfile:
+        json.dump(state, outfile)
+    run_archive_job(client, queueDir, {}, finish, 'finish.json')
+    assert archive.fetch_episode(client, BUCKET, key, 'episode_0_user_a') == data
+    assert not os.path.exists('Trials/episodes_user_a.state')
+    run_archive_job(client, queueDir, {}, finish, 'finish.json') # finished already
+    assert archive.fetch_episode(client, BUCKET, key, 'episode_0_user_a') == data
+
+def test_archive_renames_duplicates(client, queueDir):
+    key = 'p/Trials/a/episodes_user_a'
+    archives = {}
+    first = write_file('Trials/episode_0_user_a', 1000, seed=1)
+    append = {'type': 'append', 'archive': 'episodes_user_a', 'file': 'episode_0_user_a',
+              'path': 'Trials/episode_0_user_a', 'bucket': BUCKET, 'key': key, 'id': 'first'}
+    run_archive_job(client, queueDir, archives, append, '0.json')
+    run_archive_job(client, queueDir, archives, append, '0.json') # retried after a restart
+    second = write_file('Trials/episode_0_user_a', 1000, seed=2) # the participant reconnected
+    run_archive_job(client, queueDir, archives, dict(append, id='second'), '1.json')
+    run_archive_job(client, queueDir, archives, {'type': 'finish', 'archive': 'episodes_user_a',
+        'bucket': BUCKET, 'key': key}, '2.json')
+    assert [entry['name'] for entry in archive.list_episodes(client, BUCKET, key)] == ['episode_0_user_a', 'episode_0_user_a_2']
+    assert archive.fetch_episode(client, BUCKET, key, 'episode_0_user_a') == first
+    assert archive.fetch_episode(client, BUCKET, key, 'episode_0_user_a_2') == second
+
+class Stop(Exception):
+    pass
+
+class FinishedJobs():
+    '''
+    Stands in for the UploadService's job Queue, stopping run_uploads once
+    the jobs in queueDir are done.
+    '''
+
+    def __init__(self, queueDir:str):
+        self.queueDir = queueDir
+
+    def get(self):
+        for i in range(500):
+            if not any(name.endswith('.json') for name in os.listdir(self.queueDir)):
+                raise Stop()
+            sleep(0.01)
+        raise AssertionError('upload jobs did not finish')
+
+def test_orphaned_archive_finished_at_startup(client, queueDir, monkeypatch):
+    key = 'p/Trials/a/episodes_user_a'
+    data = write_file('Trials/episode_0_user_a', 1000)
+    trialArchive = archive.TrialArchive(client, BUCKET, key, 'Trials/episodes_user_a', archive.MIN_PART_SIZE)
+    trialArchive.append('episode_0_user_a', 'Trials/episode_0_user_a', 'append') # the trial never asked for a finish
+    monkeypatch.setattr(s3upload.boto3, 'client', lambda *args, **kwargs: client)
+    with pytest.raises(Stop):
+        s3upload.run_uploads(FinishedJobs(queueDir), queueDir, {'workers': 1, 'retries': 0,
+            'multipartChunkSize': archive.MIN_PART_SIZE, 'endpointUrl': None})
+    assert archive.fetch_episode(client, BUCKET, key, 'episode_0_user_a') == data
+    assert not os.path.exists('Trials/episodes_user_a.state')
+
+@pytest.mark.parametrize('size', [1000, 6 * 1024 * 1024])
+def test_archive_keeps_completed_episodes(client, queueDir, size):
+    key = 'p/Trials/a/episodes_user_a'
+    archives = {}
+    first = write_file('Trials/episode_0_user_a', size, seed=1)
+    run_archive_job(client, queueDir, archives, {'type': 'append', 'archive': 'episodes_user_a', 'file': 'episode_0_user_a',
+        'path': 'Trials/episode_0_user_a', 'bucket': BUCKET, 'key': key, 'id': 'first'}, '0.json')
+    run_archive_job(client, queueDir, archives, {'type': 'finish', 'archive': 'episodes_user_a',
+        'bucket': BUCKET, 'key': key}, '1.json')
+    second = write_file('Trials/episode_0_user_a', 1000, seed=2) # the participant reconnected after their trial was stopped
+    run_archive_job(client, queueDir, archives, {'type': 'append', 'archive': 'episodes_user_a', 'file': 'episode_0_user_a',
+        'path': 'Trials/episode_0_user_a', 'bucket': BUCKET, 'key': key, 'id': 'second'}, '2.json')
+    run_archive_job(client, queueDir, archives, {'type': 'finish', 'archive': 'episodes_user_a',
+        'bucket': BUCKET, 'key': key}, '3.json')
+    assert archive.fetch_episode(client, BUCKET, key, 'episode_0_user_a') == first
+    assert archive.fetch_episode(client, BUCKET, key, 'episode_0_user_a_2') == second
+
+def test_other_errors_fail_at_once(client, queueDir):
+    job = {'type': 'finish', 'archive': 'episodes_user_a', 'bucket': BUCKET, 'key': 'p/Trials/a/episodes_user_a'}
+    jobPath = write_job(queueDir, job)
+    calls = []
+    def corrupt(job):
+        calls.append(job)
+        raise ValueError('not a trial archive')
+    s3upload.run_job(jobPath, job, 3, corrupt)
+    assert len(calls) == 1
+    assert not os.path.exists(jobPath)
+    assert os.path.exists(jobPath[:-len('.json')] + '.failed')
+
+def test_archive_does_not_replace_other_objects(client, queueDir):
+    key = 'p/Trials/a/episodes_user_a'
+    client.put_object(Bucket=BUCKET, Key=key, Body=b'x' * 10)
+    write_file('Trials/episode_0_user_a', 1000)
+    job = {'type': 'append', 'archive': 'episodes_user_a', 'file': 'episode_0_user_a',
+           'path': 'Trials/episode_0_user_a', 'bucket': BUCKET, 'key': key, 'id': 'append'}
+    jobPath = write_job(queueDir, job)
+    s3upload.run_job(jobPath, job, 3, s3upload.archive_job, client, {}, archive.MIN_PART_SIZE)
+    assert os.path.exists(jobPath[:-len('.json')] + '.failed')
+    assert not client.list_multipart_uploads(Bucket=BUCKET).get('Uploads')
+    assert not os.path.exists('Trials/episodes_user_a.state')
+    assert body(client, key) == b'x' * 10